@@ -5,17 +5,15 @@ import sys
 import argparse
 import logging
 import nibabel as nb
-import numpy as np
+from tvb.recon.model.label_index import LabelIndex
 
 
 def label_volume_centers(label_volume):
     log = logging.getLogger('label_volume_centers')
     vol = label_volume.get_data()
     aff = label_volume.affine
-    for val in np.unique(vol):
-        vox_idx = np.argwhere(vol == val)
-        xyz = aff.dot(np.c_[vox_idx, np.ones(vox_idx.shape[0])].T)[:3].T
-        x, y, z = xyz.mean(axis=0)
+    label_index = LabelIndex(vol)
+    for val, (x, y, z) in zip(label_index.labels, label_index.centers(aff)):
         log.debug('unique value %d has center (%f, %f, %f)',
                   val, x, y, z)
         yield val, (x, y, z)
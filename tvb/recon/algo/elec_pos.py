@@ -61,29 +61,13 @@ def transform(elec_file_pom, mri_elec, t1, elec_file_t1, elec_nii_t1, transform_
     labels, coords = sensor_service.read_seeg_labels_coords_file(elec_file_pom)
     if aff_transform is not None:
         coords = aff_transform(coords.reshape((1, 3))).reshape((3,))
-    dirname = os.path.dirname(elec_file_pom)
-    coords_file = os.path.join(dirname, "seeg_coords.xyz")
-    np.savetxt(coords_file, coords, fmt='%.3e', delimiter=' ')
-    coords_file_t1 = os.path.join(dirname, "seeg_coords_in_t1.xyz")
-    # TODO correct it to get coords_in_t1
-    coords_in_t1, coords_file_t1 = volume_service.transform_coords(coords_file, mri_elec, t1, transform_mat,
-                                                                   coords_file_t1)
-    # output, std_out, time = \
-    #     execute_command("img2imgcoord %s -mm -src %s -dest %s -xfm %s > %s" \
-    #                         % (coords_file, src_img, dest_img, transform_mat, coords_file_t1),
-    #                     cwd=os.path.dirname(transform_mat), shell=True)
+    coords_in_t1, _ = volume_service.transform_coords(coords, mri_elec, t1, transform_mat)
     # Save final coordinates in t1 space to text and nifti files
-    with open(coords_file_t1) as fl:
-        lines = fl.readlines()
-    newlines = []
-    for line, label in zip(lines[1:], labels):
-        newlines.append(label + " " + line)
     with open(elec_file_t1, "w") as fl:
-        fl.writelines(newlines)
-    volume_service.gen_label_volume_from_coords(np.ones(len(labels)), elec_file_t1, labels, t1, elec_nii_t1,
-                                                skip_missing=False, dist=1)
-    # volume_service.gen_label_volume_from_coords(np.ones(len(labels)), coords_in_t1, labels, t1, elec_nii_t1,
-    #                                             skip_missing=False, dist=1)
+        for label, coord in zip(labels, coords_in_t1.reshape((-1, 3))):
+            fl.write("%s %g  %g  %g  \n" % (label, coord[0], coord[1], coord[2]))
+    volume_service.gen_label_volume_from_coords(np.ones(len(labels)), coords_in_t1.reshape((-1, 3)), labels, t1,
+                                                elec_nii_t1, skip_missing=False, dist=1)
 
 
 def main_elec_pos(patient, POM_TO_MRIELEC_TRNSFRM=False):
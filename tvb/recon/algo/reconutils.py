@@ -37,8 +37,8 @@ def convert_fs_to_brain_visa(fs_surf, bv_surf=None):
     surfaceService.convert_fs_to_brain_visa(fs_surf, bv_surf)
 
 
-def compute_gdist_mat(surf_name='pial', max_distance=40.0):
-    surfaceService.compute_gdist_mat(surf_name, max_distance)
+def compute_gdist_mat(surf_name='pial', max_distance=40.0, out_format='mat', n_jobs=1):
+    surfaceService.compute_gdist_mat(surf_name, max_distance, out_format, n_jobs)
 
 
 def aseg_surf_conc_annot(surf_path, out_surf_path, annot_path, labels,
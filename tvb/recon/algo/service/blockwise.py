@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+
+from concurrent.futures import ProcessPoolExecutor
+from typing import Callable, Optional, Union
+import numpy
+
+
+def _run_block(func: Callable, blocks: list, offset: int, length: int, args: tuple) -> numpy.ndarray:
+    # Drop the halo from the result of the block
+    return func(*blocks, *args)[offset:offset + length]
+
+
+class BlockwiseExecutor(object):
+    """
+    Run a voxel-wise or neighbourhood operation over blocks of volumes, optionally in a process pool.
+
+    The volumes are tiled into slabs along their first axis. Each slab is extended on both sides by a halo
+    of neighbouring planes, so that an operation looking at most halo voxels away gives the same result on
+    the block as on the whole volume. The halo is trimmed from the block results, which are stitched back together
+    in order, so the output is identical whatever the number of processes.
+    """
+
+    def __init__(self, n_jobs: int=1):
+        """
+        :param n_jobs: number of processes. With 1, blocks are processed one after the other in this process
+        """
+        self.n_jobs = max(1, n_jobs)
+
+    def run(self, func: Callable, arrays: Union[numpy.ndarray, list], halo: int=0, args: tuple=(),
+            out: Optional[numpy.ndarray]=None, block_length: Optional[int]=None) -> numpy.ndarray:
+        """
+        :param func: module level function taking the blocks of arrays, followed by args, and returning an array
+                     whose first axis matches the one of the blocks
+        :param arrays: array, or list of arrays with the same length along their first axis
+        :param halo: number of neighbouring planes needed on each side of a block
+        :param args: extra arguments of func, the same for all blocks
+        :param out: array to write the output to, allocated from the first block result if not given
+        :param block_length: number of planes per block. By default, the volume is split evenly across the processes,
+                             or processed in a single block with one process
+        :return: the stitched output
+        """
+        if isinstance(arrays, numpy.ndarray):
+            arrays = [arrays]
+        length = arrays[0].shape[0]
+        if block_length is None:
+            block_length = int(numpy.ceil(length / self.n_jobs))
+        block_length = max(1, block_length)
+        starts = list(range(0, length, block_length))
+        if not starts:
+            result = func(*arrays, *args)
+            if out is None:
+                return result
+            out[...] = result
+            return out
+
+        def block_inputs(start):
+            block_start = max(0, start - halo)
+            block_stop = min(length, start + block_length + halo)
+            return [array[block_start:block_stop] for array in arrays], start - block_start, block_length, args
+
+        if self.n_jobs > 1 and len(starts) > 1:
+            with ProcessPoolExecutor(max_workers=min(self.n_jobs, len(starts))) as pool:
+                futures = [pool.submit(_run_block, func, *block_inputs(start)) for start in starts]
+                for start, future in zip(starts, futures):
+                    out = self._stitch(out, future.result(), start, length)
+        else:
+            for start in starts:
+                out = self._stitch(out, _run_block(func, *block_inputs(start)), start, length)
+
+        return out
+
+    def _stitch(self, out: Optional[numpy.ndarray], block_result: numpy.ndarray, start: int, length: int) \
+            -> numpy.ndarray:
+        if out is None:
+            out = numpy.empty((length,) + block_result.shape[1:], dtype=block_result.dtype)
+        out[start:start + block_result.shape[0]] = block_result
+        return out
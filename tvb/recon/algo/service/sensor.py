@@ -186,8 +186,8 @@ class SensorService(object):
         All distances should be in mm.
         """
         DEFAULT_SPACING_PATTERN = "3.5"
+        electrodes = []
         infile = open(scheme_fname, "r")
-        outfile = open(out_fname, "w")
         for line in infile:
             line = line.strip()
             if not line or line[0] == '#':
@@ -208,15 +208,22 @@ class SensorService(object):
             entry = numpy.array([float(x) for x in [enx, eny, enz]])
             ncontacts = int(ncontacts)
             spacing_pattern = [float(x) for x in spacing_pattern_str.split()]
-            if transform_mat is not None:
-                assert src_img is not None and dest_img is not None
-                volume_service = VolumeService()
-                target = volume_service.transform_coords(target, src_img, dest_img, transform_mat)
-                entry = volume_service.transform_coords(entry, src_img, dest_img, transform_mat)
+            electrodes.append((name, target, entry, ncontacts, spacing_pattern))
+        infile.close()
+
+        if transform_mat is not None and electrodes:
+            assert src_img is not None and dest_img is not None
+            # Transform the targets and entries of all electrodes at once
+            endpoints = numpy.array([endpoint for electrode in electrodes for endpoint in electrode[1:3]])
+            endpoints, _ = VolumeService().transform_coords(endpoints, src_img, dest_img, transform_mat)
+            electrodes = [(name, endpoints[2 * i], endpoints[2 * i + 1], ncontacts, spacing_pattern)
+                          for i, (name, _, _, ncontacts, spacing_pattern) in enumerate(electrodes)]
+
+        outfile = open(out_fname, "w")
+        for name, target, entry, ncontacts, spacing_pattern in electrodes:
             contacts = self.gen_contacts_on_electrode(name, target, entry, ncontacts, spacing_pattern)
             for contact_name, pos in contacts:
                 outfile.write("%-6s %7.2f %7.2f %7.2f\n" % (contact_name, pos[0], pos[1], pos[2]))
-        infile.close()
         outfile.close()
 
     # This is from tvb_make/util/gain_matrix_seeg.py
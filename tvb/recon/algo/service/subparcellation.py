@@ -29,11 +29,8 @@ class SubparcellationService(object):
         # TODO subcort subparc with geodesic on bounding gmwmi
         # TODO normalize fiber counts by relevant gmwmi area
 
-        vertex_face_mapping = [set([]) for _ in surface.vertices]
-        for i, face in enumerate(surface.triangles):
-            for j in face:
-                vertex_face_mapping[j].add(i)
-        vertex_face_mapping = numpy.array(vertex_face_mapping)
+        vertex_face_mapping = surface.get_vertex_triangle_incidence()
+        triangle_areas = surface.get_triangle_areas()[:, 0]
 
         # Make new annotation
         new_annotation = Annotation([], [], [])
@@ -51,18 +48,14 @@ class SubparcellationService(object):
                 continue
 
             # indices of faces in ROI
-            rfi = set([])
-            for face_set in vertex_face_mapping[mask]:
-                rfi.update(face_set)
-            rfi = numpy.array(list(rfi))
+            rfi = numpy.unique(vertex_face_mapping[mask].indices)
 
             # empty roi
             if rfi.size == 0:
                 continue
 
             # compute area of faces in roi
-            roi_area = numpy.sum(self.surface_service.tri_area(
-                surface.vertices[surface.triangles[rfi]]))
+            roi_area = numpy.sum(triangle_areas[rfi])
 
             # choose k for desired roi area
             k = int(roi_area / trg_area) + 1
@@ -604,8 +597,8 @@ class SubparcellationService(object):
                        " as it stands because its connectivity area is less than 1.5 times the target value"))
                 continue
             # Get all different (dis)connected components
-            n_components, components, comp_area = \
-                self.surface_service.connected_surface_components(
+            components, comp_n_verts, comp_area = \
+                self.surface_service.compute_surface_components(
                     surface=label_surface, connectivity=dist)
             n_components = len(comp_area)
             print((str(n_components) + " connected components in total of "
@@ -615,7 +608,7 @@ class SubparcellationService(object):
             too_small_parcels = []
             for i_comp in range(n_components):
                 i_comp_verts = components == i_comp
-                n_comp_verts = numpy.sum(i_comp_verts)
+                n_comp_verts = comp_n_verts[i_comp]
                 print(("...Treating connected surface component " + str(i_comp)
                        + " of connectivity area " + str(comp_area[i_comp]) + " mm2"))
                 if comp_area[i_comp] <= MAX_PARC_AREA_RATIO * parc_area:
@@ -1,24 +1,188 @@
 # -*- coding: utf-8 -*-
 
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import zip_longest
 from typing import Optional, Union
 import glob
 import os
+import zipfile
 import gdist
+import h5py
 import numpy
 import scipy
+import scipy.io
+import scipy.sparse
 from tvb.recon.io.factory import IOUtils
 from tvb.recon.logger import get_logger
 from tvb.recon.algo.service.annotation import AnnotationService, DEFAULT_LUT
 from tvb.recon.io.volume import VolumeIO
-from tvb.recon.model.surface import Surface
+from tvb.recon.model.surface import Surface, triangle_edges
 from tvb.recon.model.annotation import Annotation
 from scipy.sparse import csr_matrix
-from scipy.sparse.csgraph import connected_components, shortest_path
+from scipy.sparse.csgraph import connected_components, dijkstra, shortest_path
+from scipy.spatial import cKDTree
 from sklearn.metrics.pairwise import paired_distances
-from scipy.spatial.distance import cdist
 from tvb.recon.algo.service.annotation import default_lut_path  # TODO into fs module
 
 
+# Meshes of the geodesic distance worker processes, set once per process by _init_gdist_worker
+_gdist_meshes = {}
+
+
+def _init_gdist_worker(meshes: dict):
+    _gdist_meshes.update(meshes)
+
+
+def _gdist_worker_rows(mesh_key, sources: numpy.ndarray, max_distance: float) -> csr_matrix:
+    return _gdist_rows(_gdist_meshes[mesh_key], sources, max_distance)
+
+
+def _gdist_rows(mesh: dict, sources: numpy.ndarray, max_distance: float) -> csr_matrix:
+    """
+    Computes the geodesic distances from each source to the vertices within max_distance, as sparse rows.
+    A geodesic path shorter than max_distance stays within the euclidean ball of that radius around its source,
+    so each source only needs the triangles of the vertices within that radius, plus the longest edge.
+    :param mesh: dict of the "vertices" and "triangles" of the mesh, where the search structures are also cached
+    :param sources: indexes of the source vertices
+    :param max_distance: maximum geodesic distance
+    :return: sparse matrix (number of sources x number of vertices) of the distances
+    """
+    vertices = mesh["vertices"]
+    triangles = mesh["triangles"]
+    if "tree" not in mesh:
+        surface = Surface(vertices, triangles)
+        edges = surface.get_edges()
+        mesh["incidence"] = surface.get_vertex_triangle_incidence()
+        mesh["max_edge"] = numpy.sqrt(numpy.max(numpy.sum((vertices[edges[:, 0]] - vertices[edges[:, 1]]) ** 2,
+                                                          axis=1), initial=0.0))
+        mesh["tree"] = cKDTree(vertices)
+        mesh["old_to_new"] = -numpy.ones((vertices.shape[0],), dtype='<i4')
+    old_to_new = mesh["old_to_new"]
+    balls = mesh["tree"].query_ball_point(vertices[sources], max_distance + mesh["max_edge"])
+    data = []
+    indices = []
+    indptr = [0]
+    for source, ball in zip(sources, balls):
+        ball = numpy.sort(numpy.array(ball, dtype='<i4'))
+        old_to_new[ball] = numpy.arange(ball.size)
+        ball_triangles = old_to_new[triangles[numpy.unique(mesh["incidence"][ball].indices)]]
+        ball_triangles = ball_triangles[(ball_triangles > -1).all(axis=1)]
+        dist = gdist.compute_gdist(vertices[ball], ball_triangles,
+                                   source_indices=numpy.array([old_to_new[source]], dtype='<i4'),
+                                   max_distance=max_distance)
+        old_to_new[ball] = -1
+        within = (dist <= max_distance) & (ball != source)
+        data.append(dist[within])
+        indices.append(ball[within])
+        indptr.append(indptr[-1] + indices[-1].size)
+    return csr_matrix((numpy.concatenate(data), numpy.concatenate(indices), indptr),
+                      shape=(len(sources), vertices.shape[0]))
+
+
+# Graph of the bounded shortest path worker processes, set once per process by _init_dijkstra_worker
+_dijkstra_graph = {}
+
+
+def _init_dijkstra_worker(graph):
+    _dijkstra_graph["graph"] = graph
+
+
+def _dijkstra_worker_rows(sources: numpy.ndarray, limit: float) -> csr_matrix:
+    return _dijkstra_rows(_dijkstra_graph["graph"], sources, limit)
+
+
+def _dijkstra_rows(graph, sources: numpy.ndarray, limit: float) -> csr_matrix:
+    # Shortest path distances from each source, up to limit, as sparse rows of the reached nodes other than the source.
+    # Zero distances, e.g. to coincident vertices, are kept as explicit entries
+    dist = dijkstra(graph, directed=False, indices=sources, limit=limit)
+    reached = numpy.isfinite(dist)
+    reached[numpy.arange(len(sources)), sources] = False
+    rows, cols = numpy.nonzero(reached)
+    return csr_matrix((dist[rows, cols].astype('single'), (rows, cols)), shape=dist.shape)
+
+
+class _H5SparseRowsWriter(object):
+    """Appends the rows of a sparse matrix to the data, indices and indptr datasets of an HDF5 file, in CSR format."""
+
+    def __init__(self, path: str, shape: tuple):
+        self.h5_file = h5py.File(path, 'w')
+        self.h5_file.attrs["shape"] = shape
+        self.data = self.h5_file.create_dataset("data", (0,), maxshape=(None,), dtype='f8', chunks=True,
+                                                compression="gzip")
+        self.indices = self.h5_file.create_dataset("indices", (0,), maxshape=(None,), dtype='i4', chunks=True,
+                                                   compression="gzip")
+        self.indptr = self.h5_file.create_dataset("indptr", (shape[0] + 1,), dtype='i8')
+        self.indptr[0] = 0
+        self.n_rows = 0
+
+    def write(self, rows: csr_matrix):
+        n_values = self.data.shape[0]
+        self.data.resize((n_values + rows.nnz,))
+        self.data[n_values:] = rows.data
+        self.indices.resize((n_values + rows.nnz,))
+        self.indices[n_values:] = rows.indices
+        self.indptr[self.n_rows + 1:self.n_rows + rows.shape[0] + 1] = n_values + rows.indptr[1:]
+        self.n_rows += rows.shape[0]
+
+    def close(self):
+        self.h5_file.close()
+
+
+class _NpzSparseRowsWriter(object):
+    """
+    Streams the rows of a sparse matrix to a compressed .npz file, in the CSR format of scipy.sparse.save_npz,
+    so that it can be read with scipy.sparse.load_npz.
+    The data and indices of the rows are appended to temporary files next to the output file, as they come,
+    and only the indptr array is held in memory. When closed, the members of the .npz file are copied
+    from the temporary files in chunks.
+    """
+
+    _COPY_CHUNK_BYTES = 2 ** 24
+
+    def __init__(self, path: str, shape: tuple):
+        self.path = path
+        self.shape = shape
+        self.data_path = path + ".data.tmp"
+        self.indices_path = path + ".indices.tmp"
+        self.data_file = open(self.data_path, 'wb')
+        self.indices_file = open(self.indices_path, 'wb')
+        self.indptr = numpy.zeros((shape[0] + 1,), dtype='i8')
+        self.n_rows = 0
+
+    def write(self, rows: csr_matrix):
+        rows.data.astype('f8').tofile(self.data_file)
+        rows.indices.astype('i4').tofile(self.indices_file)
+        self.indptr[self.n_rows + 1:self.n_rows + rows.shape[0] + 1] = self.indptr[self.n_rows] + rows.indptr[1:]
+        self.n_rows += rows.shape[0]
+
+    def _write_member(self, npz_file: zipfile.ZipFile, name: str, dtype: str, n_values: int, values_path: str):
+        with npz_file.open(name + ".npy", 'w', force_zip64=True) as member, open(values_path, 'rb') as values_file:
+            numpy.lib.format.write_array_header_1_0(
+                member, {"descr": numpy.lib.format.dtype_to_descr(numpy.dtype(dtype)), "fortran_order": False,
+                         "shape": (n_values,)})
+            chunk = values_file.read(self._COPY_CHUNK_BYTES)
+            while chunk:
+                member.write(chunk)
+                chunk = values_file.read(self._COPY_CHUNK_BYTES)
+
+    def close(self):
+        self.data_file.close()
+        self.indices_file.close()
+        try:
+            n_values = int(self.indptr[self.n_rows])
+            with zipfile.ZipFile(self.path, 'w', compression=zipfile.ZIP_DEFLATED, allowZip64=True) as npz_file:
+                self._write_member(npz_file, "indices", 'i4', n_values, self.indices_path)
+                for name, array in [("indptr", self.indptr), ("format", numpy.array("csr")),
+                                    ("shape", numpy.array(self.shape))]:
+                    with npz_file.open(name + ".npy", 'w', force_zip64=True) as member:
+                        numpy.lib.format.write_array(member, array, allow_pickle=False)
+                self._write_member(npz_file, "data", 'f8', n_values, self.data_path)
+        finally:
+            os.remove(self.data_path)
+            os.remove(self.indices_path)
+
+
 class SurfaceService(object):
     logger = get_logger(__name__)
 
@@ -62,66 +226,185 @@ class SurfaceService(object):
         for surf_name in glob.glob(surfs_glob):
             self.convert_fs_to_brain_visa(surf_name)
 
-    def merge_surfaces(self, surfaces: Surface) -> Surface:
+    def merge_surfaces(self, surfaces: list) -> Surface:
         """
-        Merge several surfaces, and their region mappings.
-        :return: the merge result surface and region mapping.
+        Merge several surfaces in a single pass, by preallocating the output arrays
+        and offsetting the triangles of each surface by the number of vertices of the previous ones.
+        :param surfaces: list of Surface objects
+        :return: the merge result surface, with the concatenated area masks.
         """
-        n_surfaces = len(surfaces)
-        out_surface = Surface([], [])
+        n_vertices = numpy.cumsum([0] + [surface.n_vertices for surface in surfaces])
+        n_triangles = numpy.cumsum([0] + [surface.n_triangles for surface in surfaces])
+        if n_vertices[-1] == 0:
+            out_surface = Surface([], [])
+        else:
+            vertices = numpy.empty((n_vertices[-1], 3),
+                                   dtype=numpy.result_type(*[surface.vertices for surface in surfaces]))
+            triangles = numpy.empty((n_triangles[-1], 3),
+                                    dtype=numpy.result_type('i', *[surface.triangles for surface in surfaces]))
+            area_mask = numpy.ones((n_vertices[-1],), dtype='bool')
+            for i_srf, surface in enumerate(surfaces):
+                vertices[n_vertices[i_srf]:n_vertices[i_srf + 1]] = surface.vertices
+                triangles[n_triangles[i_srf]:n_triangles[i_srf + 1]] = surface.triangles + n_vertices[i_srf]
+                if surface.area_mask is not None and len(surface.area_mask) > 0:
+                    area_mask[n_vertices[i_srf]:n_vertices[i_srf + 1]] = surface.area_mask
+            out_surface = Surface(vertices, triangles, area_mask)
+
         # TODO: how to deal with the metadata of merged surfaces, so that freesurfer.io can handle them, e.g., write them
-        # i.e., we need to have a final unique version of the metadata, not a list of them, as I am doing here in the
-        # commented code
-        # out_surface_attributes=dict()
-        # for attribute in ["vertices_coord_system", "generic_metadata", "vertices_metadata", "triangles_metadata"]:
-        #     out_surface_attributes[attribute]=[]
-        for i_srf in range(n_surfaces):
-            out_surface.add_vertices_and_triangles(surfaces[i_srf].vertices,
-                                                   surfaces[i_srf].triangles,
-                                                   surfaces[i_srf].area_mask)
+        # i.e., we need to have a final unique version of the metadata, not a list of them
+        for surface in surfaces:
             if out_surface.get_main_metadata() is None:
-                out_surface.set_main_metadata(surfaces[i_srf].get_main_metadata())
-            if len(surfaces[i_srf].center_ras) == 0:
+                out_surface.set_main_metadata(surface.get_main_metadata())
+            if len(surface.center_ras) == 0:
                 pass
             elif len(out_surface.center_ras) == 0:
-                out_surface.center_ras = surfaces[i_srf].center_ras
-            elif numpy.any(out_surface.center_ras != surfaces[i_srf].center_ras):
+                out_surface.center_ras = surface.center_ras
+            elif numpy.any(out_surface.center_ras != surface.center_ras):
                 self.logger.warn("At least two surfaces have different -non empty- centers in RAS coordinates!")
-            # #TODO: think about how to better merge these fields
-            # for attribute in ["vertices_coord_system", "generic_metadata", "vertices_metadata", "triangles_metadata"]:
-            #     out_surface_attributes[attribute].append(getattr(surfaces[i_srf],attribute))
-            #     setattr(out_surface,attribute,out_surface_attributes[attribute])
         return out_surface
 
-    def compute_gdist_mat(self, surf_name: str='pial', max_distance: float=40.0) -> numpy.ndarray:
+    def merge_surfaces_and_annotations(self, surfaces: list, annotations: list) -> (Surface, Annotation):
+        """
+        Merge several surfaces and their annotations in a single pass.
+        The regions of the annotations are concatenated, and the region mapping of each annotation is offset
+        by the number of regions of the previous ones, so that every vertex keeps its region name and color.
+        :param surfaces: list of Surface objects
+        :param annotations: list of Annotation objects, each with a region mapping of the vertices of its surface
+        :return: the merge result surface and annotation.
+        """
+        if len(surfaces) != len(annotations):
+            raise ValueError("Got %d surfaces but %d annotations!" % (len(surfaces), len(annotations)))
+        for surface, annotation in zip(surfaces, annotations):
+            if len(annotation.region_mapping) != surface.n_vertices:
+                raise ValueError("The region mapping of %d vertices does not match the surface of %d vertices!"
+                                 % (len(annotation.region_mapping), surface.n_vertices))
+
+        out_surface = self.merge_surfaces(surfaces)
+
+        n_regions = numpy.cumsum([0] + [len(annotation.region_names) for annotation in annotations])
+        region_mapping = numpy.empty((out_surface.n_vertices,), dtype='int64')
+        start = 0
+        for i_annot, annotation in enumerate(annotations):
+            stop = start + len(annotation.region_mapping)
+            region_mapping[start:stop] = numpy.asarray(annotation.region_mapping).ravel() + n_regions[i_annot]
+            start = stop
+        region_names = [name for annotation in annotations for name in annotation.region_names]
+        regions_color_table = numpy.concatenate(
+            [numpy.empty((0, 5), dtype='i')] +
+            [numpy.reshape(annotation.regions_color_table, (-1, 5)) for annotation in annotations]).astype('i')
+
+        return out_surface, Annotation(region_mapping, regions_color_table, region_names)
+
+    def compute_gdist_mat(self, surf_name: str='pial', max_distance: float=40.0, out_format: str='mat',
+                          n_jobs: int=1, batch_size: int=1000) -> dict:
+        """
+        Compute the geodesic distances, up to max_distance, among the vertices of both hemispheres.
+        :param surf_name: name of the freesurfer surfaces of the subject
+        :param max_distance: maximum geodesic distance
+        :param out_format: "mat" to write each hemisphere with scipy.io.savemat, or "npz" or "h5" to compute them
+                           in batches of sources, with both hemispheres processed together in n_jobs processes,
+                           and write sparse matrices (see compute_gdist_sparse)
+        :param n_jobs: number of processes, for the "npz" and "h5" formats
+        :param batch_size: number of source vertices per batch, for the "npz" and "h5" formats
+        :return: dict of the output file path of each hemisphere
+        """
         max_distance = float(max_distance)  # in case passed from sys.argv
+        subjects_dir = os.environ['SUBJECTS_DIR']
+        subject = os.environ['SUBJECT']
+        surfaces = []
+        mat_paths = {}
         for h in 'rl':
-            subjects_dir = os.environ['SUBJECTS_DIR']
-            subject = os.environ['SUBJECT']
             surf_path = '%s/%s/surf/%sh.%s' % (subjects_dir,
                                                subject, h, surf_name)
             surface = IOUtils.read_surface(surf_path, False)
-            mat_path = '%s/%s/surf/%sh.%s.gdist.mat' % (
-                subjects_dir, subject, h, surf_name)
-            mat = gdist.local_gdist_matrix(
-                surface.vertices, surface.triangles.astype('<i4'), max_distance=max_distance)
-            scipy.io.savemat(mat_path, {'gdist': mat})
-
-            return mat
+            mat_paths[h] = '%s/%s/surf/%sh.%s.gdist.%s' % (
+                subjects_dir, subject, h, surf_name, out_format)
+            if out_format == 'mat':
+                mat = gdist.local_gdist_matrix(
+                    surface.vertices, surface.triangles.astype('<i4'), max_distance=max_distance)
+                scipy.io.savemat(mat_paths[h], {'gdist': mat})
+            else:
+                surfaces.append(surface)
+        if out_format != 'mat':
+            self.compute_gdist_sparse(surfaces, list(mat_paths.values()), max_distance, n_jobs=int(n_jobs),
+                                      batch_size=int(batch_size))
+        return mat_paths
+
+    def compute_gdist_sparse(self, surfaces: list, out_paths: list, max_distance: float=40.0, n_jobs: int=1,
+                             batch_size: int=1000):
+        """
+        Compute the geodesic distances, up to max_distance, among the vertices of each surface, and write them
+        as sparse matrices (number of vertices x number of vertices), with the distances from each source on its row.
+        The sources of all surfaces are split in batches, which run in a pool of n_jobs processes.
+        The rows of each batch are appended as soon as they come, in order, to the data, indices and indptr datasets
+        of a .h5 file, or streamed to a compressed .npz file readable with scipy.sparse.load_npz, in CSR format,
+        so only the batches in flight are held in memory.
+        :param surfaces: surface objects
+        :param out_paths: output .npz or .h5 file path for each surface
+        :param max_distance: maximum geodesic distance
+        :param n_jobs: number of processes. With 1, batches are computed one after the other in this process
+        :param batch_size: number of source vertices per batch
+        """
+        meshes = {}
+        writers = []
+        tasks = []
+        for i_surf, (surface, out_path) in enumerate(zip(surfaces, out_paths)):
+            meshes[i_surf] = {"vertices": surface.vertices.astype(numpy.float64),
+                              "triangles": surface.triangles.astype('<i4')}
+            shape = (surface.n_vertices, surface.n_vertices)
+            if os.path.splitext(out_path)[1] == '.npz':
+                writers.append(_NpzSparseRowsWriter(out_path, shape))
+            else:
+                writers.append(_H5SparseRowsWriter(out_path, shape))
+            tasks.append([(i_surf, numpy.arange(start, min(start + batch_size, surface.n_vertices)))
+                          for start in range(0, surface.n_vertices, batch_size)])
+        # Interleave the batches of the surfaces, so that they are processed together
+        tasks = [task for batch_tasks in zip_longest(*tasks) for task in batch_tasks if task is not None]
+        try:
+            if n_jobs > 1:
+                with ProcessPoolExecutor(max_workers=n_jobs, initializer=_init_gdist_worker,
+                                         initargs=(meshes,)) as pool:
+                    # Keep a bounded number of batches in flight, writing them in order
+                    pending = deque()
+                    for i_surf, sources in tasks:
+                        pending.append((i_surf, pool.submit(_gdist_worker_rows, i_surf, sources, max_distance)))
+                        if len(pending) > 2 * n_jobs:
+                            i_done, future = pending.popleft()
+                            writers[i_done].write(future.result())
+                    for i_done, future in pending:
+                        writers[i_done].write(future.result())
+            else:
+                for i_surf, sources in tasks:
+                    writers[i_surf].write(_gdist_rows(meshes[i_surf], sources, max_distance))
+        finally:
+            for writer in writers:
+                writer.close()
 
     # TODO: maybe create a new "connectome" service and transfer this function there
     # TODO: add more normalizations modes
-    def compute_geodesic_dist_affinity(self, dist: numpy.ndarray, norm: bool=False) -> numpy.ndarray:
+    def compute_geodesic_dist_affinity(self, dist: numpy.ndarray, norm: bool=False, limit: Optional[float]=None,
+                                       n_jobs: int=1, batch_size: Optional[int]=None) \
+            -> Union[numpy.ndarray, csr_matrix]:
         """
         This function calculates geodesic distances among nodes of a mesh,
         starting from the array of the distances between directly connected nodes.
         Optionally, normalization with the maximum geodesic distances is performed.
         Infinite distances (corresponding to disconnected components of the mesh, are not allowed)
-        :param dist: a dense array of distances between directly connected nodes of a mesh/network
+        :param dist: a dense array or sparse matrix of distances between directly connected nodes of a mesh/network
         :param norm: a flag to be currently used for optional normalization with the maximum geodesic distance
+        :param limit: if given, only distances up to limit are computed, with a Dijkstra search bounded by limit
+                      from each node, and a sparse matrix is returned, without the nodes further than limit,
+                      but with the zero distances between distinct nodes as explicit entries.
+                      The maximum for the normalization is then the maximum distance found within limit
+        :param n_jobs: number of processes for the bounded search, which runs in batches of batch_size source nodes
+        :param batch_size: number of source nodes per batch of the bounded search. Each batch holds a dense block
+                           of batch_size x number of nodes distances, so by default it is sized to the graph,
+                           as 2 ** 22 // number of nodes
 
         :return:
         """
+        if limit is not None:
+            return self._compute_bounded_geodesic_dist(dist, norm, limit, n_jobs, batch_size)
         # TODO: make sure that this returns a symmetric matrix!
         geodist = shortest_path(dist, method='auto', directed=False,
                                 return_predecessors=False, unweighted=False, overwrite=False).astype('single')
@@ -133,35 +416,77 @@ class SurfaceService(object):
         # Convert them to normalized distances and return them
         return geodist
 
-    def extract_subsurf(self, surface: Surface, verts_mask: Union[numpy.ndarray, list], output: str='surface')\
-            -> Surface:
+    def _compute_bounded_geodesic_dist(self, dist: numpy.ndarray, norm: bool, limit: float, n_jobs: int,
+                                       batch_size: Optional[int]) -> csr_matrix:
+        n_nodes = dist.shape[0]
+        if batch_size is None:
+            batch_size = max(1, 2 ** 22 // max(1, n_nodes))
+        batches = [numpy.arange(start, min(start + batch_size, n_nodes)) for start in range(0, n_nodes, batch_size)]
+        if n_jobs > 1 and len(batches) > 1:
+            with ProcessPoolExecutor(max_workers=min(n_jobs, len(batches)), initializer=_init_dijkstra_worker,
+                                     initargs=(dist,)) as pool:
+                rows = list(pool.map(_dijkstra_worker_rows, batches, [limit] * len(batches)))
+        else:
+            rows = [_dijkstra_rows(dist, sources, limit) for sources in batches]
+        if rows:
+            geodist = scipy.sparse.vstack(rows, format='csr')
+        else:
+            geodist = csr_matrix((n_nodes, n_nodes), dtype='single')
+        if norm and geodist.nnz > 0:
+            geodist.data /= geodist.data.max()
+        return geodist
+
+    def reindex_triangles(self, triangles: numpy.ndarray, verts_mask: Union[numpy.ndarray, list]) \
+            -> (numpy.ndarray, numpy.ndarray, numpy.ndarray, numpy.ndarray):
+        """
+        Keeps the triangles of which all 3 vertices are masked and replaces their old vertex indexes with the new ones,
+        through an inverse lookup array, in time linear in the number of vertices and triangles.
+        :param triangles: triangles array (number of triangles x 3)
+        :param verts_mask: boolean mask of the vertices to keep (number of vertices x )
+        :return: the new triangles,
+                 the old indexes of the kept vertices (new -> old map),
+                 the new index of each old vertex, -1 for the ones not kept (old -> new map),
+                 and the mask of the kept triangles
+        """
+        verts_mask = numpy.asarray(verts_mask, dtype=bool)
+        verts_out_inds, = numpy.where(verts_mask)
+        old_to_new = -numpy.ones((verts_mask.size,), dtype=numpy.intp)
+        old_to_new[verts_out_inds] = numpy.arange(verts_out_inds.size)
+        triangles_mask = verts_mask[triangles].all(axis=1)
+        triangles_out = old_to_new[triangles[triangles_mask]].astype(triangles.dtype)
+        return triangles_out, verts_out_inds, old_to_new, triangles_mask
+
+    def extract_subsurf(self, surface: Surface, verts_mask: Union[numpy.ndarray, list], output: str='surface',
+                        return_index_maps: bool=False) -> Union[Surface, tuple]:
         """
         Extracts a sub-surface that contains only the masked vertices and the corresponding faces.
         An important step is to replace old vertices indexes of faces to the new ones.
         :param: surface: input surface object
         :param: verts_mask: mask of the sub-surface to be extracted
-        :return: output surface object
+        :param: output: 'surface' to return a Surface object, otherwise its vertices, triangles and area mask
+        :param: return_index_maps: if True, also return the new -> old and old -> new vertex index maps
+        :return: with output='surface', the output surface object,
+                 or the tuple (surface, verts_out_inds, old_to_new) if return_index_maps is True.
+                 Otherwise, the tuple (vertices, triangles, area_mask),
+                 or (vertices, triangles, area_mask, verts_out_inds, old_to_new) if return_index_maps is True.
+                 verts_out_inds are the old indexes of the kept vertices,
+                 and old_to_new the new index of each old vertex, -1 for the ones not kept
         """
-
-        verts_out = surface.vertices[verts_mask]
-        triangles_mask = numpy.c_[verts_mask[surface.triangles[:, 0]],
-                                  verts_mask[surface.triangles[:, 1]],
-                                  verts_mask[surface.triangles[:, 2]]].all(axis=1)
-        triangles_out = numpy.array(surface.triangles[triangles_mask, :])
-        verts_out_inds, = numpy.where(verts_mask)
-        for triang_idx in range(triangles_out.shape[0]):
-            for vertex_idx in range(3):
-                triangles_out[triang_idx, vertex_idx], = \
-                    numpy.where(
-                        triangles_out[triang_idx, vertex_idx] == verts_out_inds)
+        triangles_out, verts_out_inds, old_to_new, _ = self.reindex_triangles(surface.triangles, verts_mask)
+        verts_out = surface.vertices[verts_out_inds]
         if output == 'surface':
             out_surface = Surface(verts_out, triangles_out, area_mask=surface.area_mask[verts_out_inds],
                                   center_ras=surface.center_ras, vertices_coord_system=surface.vertices_coord_system,
                                   generic_metadata=surface.generic_metadata,
                                   vertices_metadata=surface.vertices_metadata,
                                   triangles_metadata=surface.triangles_metadata)
+            if return_index_maps:
+                return out_surface, verts_out_inds, old_to_new
             return out_surface
         else:
+            if return_index_maps:
+                return (verts_out, triangles_out,
+                        surface.area_mask[verts_out_inds], verts_out_inds, old_to_new)
             return (verts_out, triangles_out,
                     surface.area_mask[verts_out_inds])
 
@@ -172,13 +497,19 @@ class SurfaceService(object):
             :param area_mask: optional boolean mask (number of vertices x ) to overwrite the surface.area_mask
             :return: (sub)surface area, float
             """
-        if area_mask is None:
-            area_mask = surface.area_mask
-        # Apply the mask in order to extract the sub-surface (vertices and
-        # relevant triangles)
-        (vertices, triangles) = self.extract_subsurf(
-            surface, area_mask, output='verts_triangls')[:2]
-        return numpy.sum(self.tri_area(vertices[triangles]))
+        # Sum the areas of the triangles of which all 3 vertices are in the mask
+        return surface.get_masked_area(area_mask)
+
+    def triangle_edges(self, triangles: numpy.ndarray, n_vertices: int, directed: bool=False) -> numpy.ndarray:
+        """
+        Computes the unique edges of a mesh from its triangles.
+        :param triangles: triangles array (number of triangles x 3)
+        :param n_vertices: number of vertices of the mesh
+        :param directed: if True, (i, j) and (j, i) are different edges,
+                         otherwise each edge is returned once, as (min(i, j), max(i, j))
+        :return: the edges, sorted, numpy.ndarray of shape (number of edges, 2)
+        """
+        return triangle_edges(triangles, n_vertices, directed)
 
     def vertex_connectivity(self, surface: Surface, mode: str="sparse", metric: Optional[str]=None,
                             symmetric: bool=False, verts_mask: Union[numpy.ndarray, list]=None) \
@@ -198,92 +529,104 @@ class SurfaceService(object):
         else:
             vertices = surface.vertices
             triangles = surface.triangles
-        # Get all pairs of vertex indexes (i.e., edges) that appear in each
-        # face (triangle)
-        edges = numpy.r_[triangles[:, [0, 1]],
-                         triangles[:, [1, 2]], triangles[:, [2, 0]]]
-        # Remove repetitions
-        edges = numpy.vstack(set(map(tuple, edges)))
-        # Mark all existing pairs to 1
         n_v = vertices.shape[0]
-        n_e = edges.shape[0]
-        # For symmetric output...
-        if symmetric:
-            # ...create for the moment the "double" edges
-            edges2 = numpy.r_[edges, edges[:, [1, 0]]]
+        # Get all unique pairs of vertex indexes (i.e., edges) that appear in each face (triangle),
+        # as undirected edges for symmetric output, or as they are oriented in the faces otherwise
+        if verts_mask is None and symmetric:
+            edges = surface.get_edges()
+        else:
+            edges = self.triangle_edges(triangles, n_v, directed=not symmetric)
         if metric is None:
-            # For symmetric output...
-            if symmetric:
-                # ...remove repetitions of edges2
-                edges = numpy.vstack(set(map(tuple, edges2)))
-                n_e = edges.shape[0]
-            con = csr_matrix(
-                (numpy.ones((n_e,)), (edges[:, 0], edges[:, 1])), shape=(n_v, n_v))
-            if mode != "sparse":
-                # Create non-sparse matrix
-                con = con.todense()
+            # Mark all existing pairs to 1
+            weights = numpy.ones((edges.shape[0],))
         else:
-            d = paired_distances(vertices[edges[:, 0]], vertices[
-                edges[:, 1]], metric)
-            # For symmetric output...
-            if symmetric:
-                # double also d...
-                d = numpy.r_[d, d]
-                edges = edges2
-            if mode == "sparse":
-                # Create sparse matrix
-                con = csr_matrix(
-                    (d, (edges[:, 0], edges[:, 1])), shape=(n_v, n_v))
+            weights = paired_distances(vertices[edges[:, 0]], vertices[edges[:, 1]], metric=metric)
+        # For symmetric output add the reverse of each edge, with the same weight
+        if symmetric:
+            reverse = edges[:, 0] != edges[:, 1]
+            edges = numpy.r_[edges, edges[reverse][:, [1, 0]]]
+            weights = numpy.r_[weights, weights[reverse]]
+        con = csr_matrix((weights, (edges[:, 0], edges[:, 1])), shape=(n_v, n_v))
+        if mode != "sparse":
+            # Create non-sparse matrix
+            con = con.todense()
         return con
 
-    # TODO: use surface instead of verts and faces?? Denis: not sure about
-    # this!..
-    def connected_surface_components(self, surface: Optional[Surface]=None, connectivity: Optional[numpy.ndarray]=None,
-                                     verts_mask: Optional[Union[numpy.ndarray, list]]=None) \
-            -> (int, numpy.ndarray,  numpy.ndarray):
+    def compute_surface_components(self, surface: Optional[Surface]=None, connectivity: Optional[numpy.ndarray]=None,
+                                   verts_mask: Optional[Union[numpy.ndarray, list]]=None) \
+            -> (numpy.ndarray, numpy.ndarray, Optional[numpy.ndarray]):
         """
-        This function returns all the different disconnected components of a surface, their number and their areas,
-        after applying an optional boolean mask to exclude some subsurface from the whole computation.
-        There should be at least one component returned, if the whole surface is connected.
-        :param surface: input surface object
+        This function labels the disconnected components of a surface and computes their number of vertices
+        and their areas, with one connected components search and one grouped reduction over the triangles.
+        An optional boolean mask restricts the computation to a subset of the vertices,
+        without extracting a sub-surface.
+        :param surface: input surface object, of which the cached adjacency is used if no connectivity is given
         :param connectivity: optionally an array or sparse matrix of structural connectivity constraints,
                             where True or 1 or entry>0 stands for the existing direct connections
                             among neighboring vertices (i.e., vertices of a common triangular face)
         :param verts_mask: optional boolean mask (number of vertices x ) for vertices to include to the input surface
-        :return:
+        :return: the component of each vertex (-1 for vertices out of the mask),
+                 the number of vertices of each component,
+                 and the area of each component, as the area of its triangles of which all 3 vertices
+                 are also in the area_mask of the surface, or None without a surface
         """
-        if (surface is None) and connectivity is None:
-            print("Error: neither a surface, nor a connectivity matrix in the input!")
-            return 0
-        elif connectivity is None:
-            n_verts = surface.vertices.shape[0]
-            # Create the connectivity matrix, if not in the input:
-            connectivity = self.vertex_connectivity(
-                surface, verts_mask=verts_mask)
+        if verts_mask is not None:
+            verts_mask = numpy.asarray(verts_mask, dtype=bool)
+        if connectivity is None:
+            n_verts = surface.n_vertices
             if verts_mask is None:
-                verts_mask = numpy.ones((n_verts,), dtype=bool)
+                connectivity = surface.get_adjacency()
+            else:
+                # Connect the masked vertices through the triangles of which all 3 vertices are masked
+                masked_triangles, masked_verts_inds, _, _ = self.reindex_triangles(surface.triangles, verts_mask)
+                edges = triangle_edges(masked_triangles, masked_verts_inds.size)
+                connectivity = csr_matrix((numpy.ones((edges.shape[0],)), (edges[:, 0], edges[:, 1])),
+                                          shape=(masked_verts_inds.size, masked_verts_inds.size))
         else:
             n_verts = connectivity.shape[0]
-            if verts_mask is None:
-                verts_mask = numpy.ones((n_verts,), dtype=bool)
-            else:
+            if verts_mask is not None:
                 connectivity = connectivity[verts_mask, :][:, verts_mask]
+        if verts_mask is None:
+            verts_mask = numpy.ones((n_verts,), dtype=bool)
         # Find all connected components of this surface
         (n_components, components_masked) = \
             connected_components(connectivity, directed=False,
                                  connection='weak', return_labels=True)
-        comp_area = []
-        if surface is not None:
-            # For each component...
-            for ic in range(n_components):
-                i_comp_verts = components_masked == ic
-                # ...compute the surface area, after applying any specified mask
-                comp_area.append(self.compute_surface_area(surface,
-                                                           mask=numpy.logical_and(i_comp_verts, surface.area_mask)))
+        comp_counts = numpy.bincount(components_masked, minlength=n_components)
         # Prepare final components' labels output:
         components = -numpy.ones((n_verts,)).astype('i')
         components[verts_mask] = components_masked
-        return n_components, components, numpy.array(comp_area)
+        comp_areas = None
+        if surface is not None:
+            # Sum the areas of the triangles with all 3 vertices in the same component and in the area mask
+            triangle_comps = numpy.where(surface.area_mask, components, -1)[surface.triangles]
+            in_component = (triangle_comps[:, 0] > -1) & (triangle_comps[:, 0] == triangle_comps[:, 1]) & \
+                           (triangle_comps[:, 1] == triangle_comps[:, 2])
+            comp_areas = numpy.bincount(triangle_comps[in_component, 0],
+                                        weights=surface.get_triangle_areas()[in_component, 0], minlength=n_components)
+        return components, comp_counts, comp_areas
+
+    def connected_surface_components(self, surface: Optional[Surface]=None, connectivity: Optional[numpy.ndarray]=None,
+                                     verts_mask: Optional[Union[numpy.ndarray, list]]=None) \
+            -> (int, numpy.ndarray,  numpy.ndarray):
+        """
+        This function returns all the different disconnected components of a surface, their number and their areas,
+        after applying an optional boolean mask to exclude some subsurface from the whole computation.
+        There should be at least one component returned, if the whole surface is connected.
+        :param surface: input surface object
+        :param connectivity: optionally an array or sparse matrix of structural connectivity constraints,
+                            where True or 1 or entry>0 stands for the existing direct connections
+                            among neighboring vertices (i.e., vertices of a common triangular face)
+        :param verts_mask: optional boolean mask (number of vertices x ) for vertices to include to the input surface
+        :return:
+        """
+        if (surface is None) and connectivity is None:
+            print("Error: neither a surface, nor a connectivity matrix in the input!")
+            return 0
+        components, comp_counts, comp_areas = self.compute_surface_components(surface, connectivity, verts_mask)
+        if comp_areas is None:
+            comp_areas = numpy.array([])
+        return comp_counts.size, components, comp_areas
 
     def aseg_surf_conc_annot(self, surf_path: str, out_surf_path: str, annot_path: str,
                              label_indices: Union[numpy.ndarray, list], lut_path: Optional[str]=None) -> Surface:
@@ -297,25 +640,18 @@ class SurfaceService(object):
                                                                                    labels=label_indices)
         label_indices = numpy.array(label_indices.split()).astype('i')
 
-        #                  verts tri area_mask cras
         surfaces = []
-        out_annotation = Annotation([], [], [])
-        label_number = -1
-
+        annotations = []
         for label_index in label_indices:
             # TODO: This is hardcoded: /aseg-%06d here and also in pegasus dax generator
             this_surf_path = surf_path + "/aseg-%06d" % int(label_index)
 
             if os.path.exists(this_surf_path):
                 ind_l, = numpy.where(label_indices == label_index)
-                out_annotation.add_region_names_and_colors(
-                    label_names[int(ind_l)],
-                    color_table[ind_l, :])
-                label_number += 1
                 surfaces.append(IOUtils.read_surface(this_surf_path, False))
-                out_annotation.add_region_mapping(
-                    label_number * numpy.ones((surfaces[-1].n_vertices,), dtype='int64'))
-        out_surface = self.merge_surfaces(surfaces)
+                annotations.append(Annotation(numpy.zeros((surfaces[-1].n_vertices,), dtype='int64'),
+                                              color_table[ind_l, :], [label_names[int(ind_l)]]))
+        out_surface, out_annotation = self.merge_surfaces_and_annotations(surfaces, annotations)
         # out_annotation.regions_color_table = numpy.squeeze(numpy.array(out_annotation.regions_color_table).astype('i'))
 
         IOUtils.write_surface(out_surf_path, out_surface)
@@ -336,6 +672,13 @@ class SurfaceService(object):
 
             return grid, n_grid
 
+    def __is_target_label(self, surf_vxls: numpy.ndarray, target_labels: numpy.ndarray, add_lbl: list) \
+            -> numpy.ndarray:
+        is_target = surf_vxls == target_labels
+        if len(add_lbl) > 0:
+            is_target |= numpy.in1d(surf_vxls, add_lbl).reshape(surf_vxls.shape)
+        return is_target
+
     def sample_vol_on_surf(self, surf_path: str, vol_path: str, annot_path: str, out_surf_path: str,
                            cras_path: str, add_string: str='', vertex_neighbourhood: int=1,
                            add_lbl: list=[], lut_path: Optional[str]=None) -> (Surface, Annotation):
@@ -361,92 +704,52 @@ class SurfaceService(object):
 
         cras = numpy.loadtxt(cras_path)
 
-        grid, n_grid = self.__prepare_grid(vertex_neighbourhood)
-
-        # Initialize the output mask:
-        verts_out_mask = numpy.repeat([False], surface.vertices.shape[0])
         for label_index in range(len(region_mapping_indexes)):
-
             self.logger.info("%s", add_string +
                              annotation.region_names[label_index])
 
-            # Get the indexes of the vertices corresponding to this label:
-            verts_indices_of_label, = numpy.where(
-                annotation.region_mapping[:] == region_mapping_indexes[label_index])
-            verts_indices_of_label_size = verts_indices_of_label.size
-            if verts_indices_of_label_size == 0:
-                continue
-
-            # Add any additional labels
-            all_labels = [labels[label_index]] + add_lbl
-
-            # get the vertices for current label and add cras to take them to
-            # scanner ras
-            verts_of_label = surface.vertices[verts_indices_of_label, :]
-            verts_of_label += numpy.repeat(numpy.expand_dims(
-                cras, 1).T, verts_indices_of_label_size, axis=0)
-
-            # Compute the nearest voxel coordinates using the affine transform
-            ijk = numpy.round(
-                ras2vox_affine_matrix.dot(numpy.c_[verts_of_label, numpy.ones(verts_indices_of_label_size)].T)[:3].T) \
-                .astype('i')
-
-            # Get the labels of these voxels:
-            surf_vxls = volume.data[ijk[:, 0], ijk[:, 1], ijk[:, 2]]
-
-            # Vertex mask to keep: those that correspond to voxels of one of
-            # the target labels
-            # surf_vxls==lbl if only one target label
-            verts_keep, = numpy.where(numpy.in1d(surf_vxls, all_labels))
-            verts_out_mask[verts_indices_of_label[verts_keep]] = True
-
-            if vertex_neighbourhood > 0:
-                # These are now the remaining indexes to be checked for
-                # neighboring voxels
-                verts_indices_of_label = numpy.delete(
-                    verts_indices_of_label, verts_keep)
-                ijk = numpy.delete(ijk, verts_keep, axis=0)
-
-                for vertex_index in range(verts_indices_of_label.size):
-                    # Generate the specific grid centered at the voxel ijk
-                    ijk_grid = grid + \
-                               numpy.tile(ijk[vertex_index, :], (n_grid, 1))
-
-                    # Remove voxels outside the volume
-                    indexes_within_limits = numpy.all([(ijk_grid[:, 0] >= 0), (ijk_grid[:, 0] < volume.dimensions[0]),
-                                                       (ijk_grid[:, 1] >= 0), (ijk_grid[
-                                                                               :, 1] < volume.dimensions[1]),
-                                                       (ijk_grid[:, 2] >= 0), (ijk_grid[:, 2] < volume.dimensions[2])],
-                                                      axis=0)
-                    ijk_grid = ijk_grid[indexes_within_limits, :]
-                    surf_vxls = volume.data[
-                        ijk_grid[:, 0], ijk_grid[:, 1], ijk_grid[:, 2]]
-
-                    # If any of the neighbors is of the target labels include
-                    # the current vertex
-                    # surf_vxls==lbl if only one target label
-                    if numpy.any(numpy.in1d(surf_vxls, all_labels)):
-                        verts_out_mask[
-                            verts_indices_of_label[vertex_index]] = True
-
-        # Vertex indexes and vertices to keep:
-        verts_out_indices, = numpy.where(verts_out_mask)
-        verts_out = surface.vertices[verts_out_indices]
+        # The target label of each vertex, as the label of its position in the region mapping indexes
+        region_mapping = numpy.asarray(annotation.region_mapping[:])
+        vertices_labels = numpy.asarray(labels)[numpy.searchsorted(region_mapping_indexes, region_mapping)]
+
+        # Compute the nearest voxel coordinates of all vertices using the affine transform,
+        # after adding cras to take them to scanner ras
+        vertices = numpy.ascontiguousarray(surface.vertices + numpy.reshape(cras, (1, 3)), dtype='float64')
+        ijk = numpy.round(vertices.dot(numpy.ascontiguousarray(ras2vox_affine_matrix[:3, :3].T))
+                          + ras2vox_affine_matrix[:3, 3]).astype('i')
 
+        # The vertices the nearest voxel of which is out of the volume are dropped
+        within_volume = numpy.all((ijk >= 0) & (ijk < numpy.array(volume.dimensions[:3])), axis=1)
+        ijk[~within_volume] = 0
+
+        # Vertex mask to keep: those that correspond to voxels of the target label of the vertex,
+        # or of one of the additional labels
+        verts_out_mask = within_volume & self.__is_target_label(volume.data[ijk[:, 0], ijk[:, 1], ijk[:, 2]],
+                                                                vertices_labels, add_lbl)
+
+        if vertex_neighbourhood > 0:
+            grid, n_grid = self.__prepare_grid(vertex_neighbourhood)
+            # These are now the remaining vertices to be checked for neighboring voxels,
+            # in batches of bounded size of the neighborhoods
+            verts_indices_to_check, = numpy.where(within_volume & ~verts_out_mask)
+            batch_size = max(1, 2 ** 22 // n_grid)
+            for start in range(0, verts_indices_to_check.size, batch_size):
+                verts_indices = verts_indices_to_check[start:start + batch_size]
+                # Generate the grids centered at the voxels ijk, (number of vertices x number of grid points x 3)
+                ijk_grid = ijk[verts_indices, numpy.newaxis, :] + grid[numpy.newaxis, :, :]
+                # Exclude the voxels outside the volume
+                within_limits = numpy.all((ijk_grid >= 0) & (ijk_grid < numpy.array(volume.dimensions[:3])), axis=2)
+                ijk_grid[~within_limits] = 0
+                surf_vxls = volume.data[ijk_grid[:, :, 0], ijk_grid[:, :, 1], ijk_grid[:, :, 2]]
+                # If any of the neighbors is of the target labels include the vertex
+                is_target = self.__is_target_label(surf_vxls, vertices_labels[verts_indices, numpy.newaxis], add_lbl)
+                verts_out_mask[verts_indices] = numpy.any(is_target & within_limits, axis=1)
+
+        # Keep the vertices of the mask, and only the triangles of which all 3 vertices are included,
+        # with their old vertices' indexes transformed to the new ones:
         # TODO maybe: make sure that all voxels of this label correspond to at least one vertex.
-        # Create a similar mask for faces by picking only triangles of which
-        # all 3 vertices are included
-        face_out_mask = numpy.c_[
-            verts_out_mask[surface.triangles[:, 0]], verts_out_mask[surface.triangles[:, 1]], verts_out_mask[
-                surface.triangles[:, 2]]].all(axis=1)
-        faces_out = surface.triangles[face_out_mask]
-
-        # The old vertices' indexes of faces have to be transformed to the new
-        # vrtx_out_inds:
-        for iF in range(faces_out.shape[0]):
-            for vertex_index in range(3):
-                faces_out[iF, vertex_index], = numpy.where(
-                    faces_out[iF, vertex_index] == verts_out_indices)
+        faces_out, verts_out_indices, _, _ = self.reindex_triangles(surface.triangles, verts_out_mask)
+        verts_out = surface.vertices[verts_out_indices]
 
         surface.vertices = verts_out
         surface.triangles = faces_out
@@ -456,7 +759,7 @@ class SurfaceService(object):
         IOUtils.write_surface(out_surf_path, surface)
 
         annotation.set_region_mapping(
-            annotation.get_region_mapping_by_indices([verts_out_indices]))
+            annotation.get_region_mapping_by_indices(verts_out_indices))
         IOUtils.write_annotation(out_surf_path + ".annot", annotation)
 
         numpy.save(out_surf_path + "-idx.npy", verts_out_indices)
@@ -464,10 +767,61 @@ class SurfaceService(object):
 
         return surface, annotation
 
+    def find_nearest_nodes(self, points: numpy.ndarray, nodes_xyz: numpy.ndarray, max_distance: Optional[float]=None,
+                           batch_size: int=100000, n_neighbors: int=4) \
+            -> (numpy.ndarray, numpy.ndarray, numpy.ndarray):
+        """
+        This function finds the nearest node of each point, with a KD-tree of the nodes queried in batches of points,
+        instead of the full matrix of the distances between points and nodes.
+        Ties are resolved to the node of the lowest index, as numpy.argmin over the euclidean distances would.
+        :param points: coordinates of the points (number of points x 3)
+        :param nodes_xyz: coordinates of the nodes (number of nodes x 3)
+        :param max_distance: optional distance above which a point is flagged as too far from any node
+        :param batch_size: number of points per query
+        :param n_neighbors: number of neighbors retrieved per point, to detect ties
+        :return: the index of the nearest node of each point, the distance to it,
+                 and a boolean mask of the points further than max_distance from their nearest node
+        """
+        points = numpy.asarray(points)
+        nodes_xyz = numpy.asarray(nodes_xyz)
+        tree = cKDTree(nodes_xyz)
+        n_neighbors = min(n_neighbors, nodes_xyz.shape[0])
+        nearest = numpy.zeros((points.shape[0],), dtype=numpy.intp)
+        distances = numpy.zeros((points.shape[0],))
+        for start in range(0, points.shape[0], batch_size):
+            batch = points[start:start + batch_size]
+            tree_distances, neighbors = tree.query(batch, k=n_neighbors)
+            tree_distances = tree_distances.reshape((batch.shape[0], n_neighbors))
+            neighbors = neighbors.reshape((batch.shape[0], n_neighbors))
+            # Recompute the distances of the neighbors (almost) as close as the nearest one, the same way as cdist,
+            # and keep the lowest node index among the closest ones
+            tolerance = 1e-9 * tree_distances[:, :1] + 1e-12
+            candidates = tree_distances <= tree_distances[:, :1] + tolerance
+            neighbor_distances = numpy.sqrt(numpy.sum((batch[:, numpy.newaxis, :] - nodes_xyz[neighbors]) ** 2, axis=2))
+            neighbor_distances[~candidates] = numpy.inf
+            closest = neighbor_distances == numpy.min(neighbor_distances, axis=1)[:, numpy.newaxis]
+            nearest[start:start + batch.shape[0]] = numpy.min(numpy.where(closest, neighbors, nodes_xyz.shape[0]),
+                                                              axis=1)
+            distances[start:start + batch.shape[0]] = numpy.min(neighbor_distances, axis=1)
+            # If all the retrieved neighbors are candidates, there might be more: check all nodes within that distance
+            if n_neighbors < nodes_xyz.shape[0]:
+                for i_point in numpy.where(candidates[:, -1])[0]:
+                    ball = numpy.sort(tree.query_ball_point(batch[i_point], tree_distances[i_point, -1] +
+                                                            tolerance[i_point, 0]))
+                    ball_distances = numpy.sqrt(numpy.sum((batch[i_point] - nodes_xyz[ball]) ** 2, axis=1))
+                    nearest[start + i_point] = ball[numpy.argmin(ball_distances)]
+                    distances[start + i_point] = numpy.min(ball_distances)
+        if max_distance is None:
+            too_far = numpy.zeros((points.shape[0],), dtype=bool)
+        else:
+            too_far = distances > max_distance
+        return nearest, distances, too_far
+
     # TODO: maybe create a new "connectome" service and transfer this function
     # there
     def compute_consim_affinity(self, verts: numpy.ndarray, vox: Union[numpy.ndarray, list], voxxzy: numpy.ndarray,
-                                con: numpy.ndarray, cras: Optional[Union[numpy.ndarray, list]]=None) -> numpy.ndarray:
+                                con: numpy.ndarray, cras: Optional[Union[numpy.ndarray, list]]=None,
+                                max_distance: Optional[float]=None) -> numpy.ndarray:
         """
         This function creates a connectome affinity matrix among vertices,
         starting from an affinity matrix among voxels,
@@ -478,63 +832,110 @@ class SurfaceService(object):
         :param con: connectivity affinity matrix
         :param cras: center ras point to be optionally added to the vertices coordinates
                     (being probably in freesurfer tk-ras or surface ras coordinates) to align with the volume voxels
+        :param max_distance: optional distance to warn about vertices further from their nearest voxel node
         :return: the affinity matrix among vertices
         """
         # Add the cras to take them to scanner ras coordinates, if necessary:
         if cras is not None:
-            verts += numpy.repeat(numpy.expand_dims(cras,
-                                                    1).T, verts.shape[0], axis=0)
+            verts = verts + numpy.reshape(cras, (1, 3))
         # TODO?: to use aparc+aseg to correspond vertices only to voxels of the same label
         # There would have to be a vertex->voxel of aparc+aseg of the same label -> voxel of tdi_lbl_in_T1 mapping
         # Maybe redundant  because we might be ending to the same voxel of tdi_lbl anyway...
         # Something to test/discuss...
         # Find for each vertex the closest voxel node in terms of euclidean
         # distance:
-        v2n = numpy.argmin(cdist(verts, voxxzy, 'euclidean'), axis=1)
+        v2n, _, too_far = self.find_nearest_nodes(verts, voxxzy, max_distance)
+        if numpy.any(too_far):
+            self.logger.warning("%d vertices are further than %s from any voxel node", numpy.sum(too_far), max_distance)
         # Assign to each vertex the integer identity of the nearest voxel node.
-        v2n = vox[v2n]
+        v2n = numpy.asarray(vox)[v2n]
         print("...surface component's vertices correspond to " +
               str(numpy.size(numpy.unique(v2n))) + " distinct voxel nodes")
         affinity = con[v2n - 1, :][:, v2n - 1]
         return affinity
 
-    # TODO: keep the commented methods definition in py3
+    def _region_vertex_indices(self, regions: Union[numpy.ndarray, list], region_mapping: Union[numpy.ndarray, list]) \
+            -> (numpy.ndarray, numpy.ndarray, int):
+        """
+        Finds the position of the region of each vertex among the unique regions, in one sorted search.
+        :return: the position of the region of each vertex (the number of unique regions if not one of the regions),
+                 the position of each of the given regions among the unique regions,
+                 and the number of unique regions
+        """
+        unique_regions, regions_inverse = numpy.unique(regions, return_inverse=True)
+        n_regions = unique_regions.size
+        region_mapping = numpy.asarray(region_mapping)
+        if region_mapping.dtype == object:
+            # e.g. with None for vertices without a region
+            region_positions = dict(zip(unique_regions.tolist(), range(n_regions)))
+            vertex_inds = numpy.fromiter((region_positions.get(region, n_regions) for region in region_mapping),
+                                         dtype=numpy.intp, count=region_mapping.size)
+        else:
+            vertex_inds = numpy.searchsorted(unique_regions, region_mapping)
+            if n_regions > 0:
+                in_regions = unique_regions[numpy.minimum(vertex_inds, n_regions - 1)] == region_mapping
+                vertex_inds[~in_regions] = n_regions
+        return vertex_inds, regions_inverse, n_regions
+
+    def _grouped_region_areas(self, surface: Surface, vertex_inds: numpy.ndarray, n_regions: int) -> numpy.ndarray:
+        # A triangle counts once for the region of each of its vertices, so that triangles on the border of regions
+        # count for all their regions
+        triangle_inds = vertex_inds[surface.triangles]
+        first_of_region = numpy.c_[numpy.ones((surface.n_triangles,), dtype=bool),
+                                   triangle_inds[:, 1] != triangle_inds[:, 0],
+                                   (triangle_inds[:, 2] != triangle_inds[:, 0]) &
+                                   (triangle_inds[:, 2] != triangle_inds[:, 1])]
+        triangle_areas = numpy.broadcast_to(surface.get_triangle_areas(), triangle_inds.shape)
+        return numpy.bincount(triangle_inds[first_of_region], weights=triangle_areas[first_of_region],
+                              minlength=n_regions + 1)[:n_regions]
+
+    def _grouped_region_means(self, values: numpy.ndarray, vertex_inds: numpy.ndarray, n_regions: int) \
+            -> (numpy.ndarray, numpy.ndarray):
+        counts = numpy.bincount(vertex_inds, minlength=n_regions + 1)[:n_regions]
+        sums = numpy.zeros((n_regions, values.shape[1]))
+        for axis in range(values.shape[1]):
+            sums[:, axis] = numpy.bincount(vertex_inds, weights=values[:, axis], minlength=n_regions + 1)[:n_regions]
+        means = numpy.zeros((n_regions, values.shape[1]))
+        means[counts > 0] = sums[counts > 0] / counts[counts > 0, numpy.newaxis]
+        return means, counts
+
+    def _normalize_orientations(self, orientations: numpy.ndarray, counts: numpy.ndarray) -> numpy.ndarray:
+        orientations[counts > 0] /= numpy.sqrt(numpy.sum(orientations[counts > 0] ** 2, axis=1))[:, numpy.newaxis]
+        return orientations
+
+    def compute_region_statistics(self, regions: Union[numpy.ndarray, list], surface: Surface,
+                                  region_mapping: Union[numpy.ndarray, list]) \
+            -> (numpy.ndarray, numpy.ndarray, numpy.ndarray):
+        """
+        Compute the areas, centers and average orientations of all given regions, in one pass over the vertices
+        and triangles.
+        :param regions: region values, as in the region mapping
+        :param surface: input surface object
+        :param region_mapping: region value of each vertex
+        :return: areas (number of regions x ), centers and orientations (number of regions x 3),
+                 0 for regions without vertices
+        """
+        vertex_inds, regions_inverse, n_regions = self._region_vertex_indices(regions, region_mapping)
+        areas = self._grouped_region_areas(surface, vertex_inds, n_regions)
+        centers, counts = self._grouped_region_means(surface.vertices, vertex_inds, n_regions)
+        orientations, _ = self._grouped_region_means(surface.vertex_normals(), vertex_inds, n_regions)
+        orientations = self._normalize_orientations(orientations, counts)
+        return areas[regions_inverse], centers[regions_inverse], orientations[regions_inverse]
+
     def compute_areas_for_regions(self, regions: list, surface: Surface, region_mapping: list) -> numpy.array:
         """Compute the areas of given regions"""
-
-        region_surface_area = numpy.zeros(len(regions))
-        avt = numpy.array(surface.get_vertex_triangles())
         # NOTE: Slightly overestimates as it counts overlapping border triangles,
         #       but, not really a problem provided triangle-size << region-size.
-        for i, k in enumerate(regions):
-            regs = list(map(set, avt[numpy.array(region_mapping) == k]))
-            if len(regs) == 0:
-                continue
-            region_triangles = set.union(*regs)
-            if region_triangles:
-                region_surface_area[i] = surface.get_triangle_areas()[list(region_triangles)].sum()
-
-        return region_surface_area
+        vertex_inds, regions_inverse, n_regions = self._region_vertex_indices(regions, region_mapping)
+        return self._grouped_region_areas(surface, vertex_inds, n_regions)[regions_inverse]
 
     def compute_orientations_for_regions(self, regions, surface, region_mapping) -> numpy.ndarray:
         """Compute the orientation of given regions from vertex_normals and region mapping"""
-
-        average_orientation = numpy.zeros((len(regions), 3))
-        vertex_normals = surface.vertex_normals()
         # Average orientation of the region
-        for i, k in enumerate(regions):
-            orient = vertex_normals[numpy.array(region_mapping) == k, :]
-            if orient.shape[0] > 0:
-                avg_orient = numpy.mean(orient, axis=0)
-                average_orientation[i, :] = avg_orient / numpy.sqrt(numpy.sum(avg_orient ** 2))
-
-        return average_orientation
+        vertex_inds, regions_inverse, n_regions = self._region_vertex_indices(regions, region_mapping)
+        orientations, counts = self._grouped_region_means(surface.vertex_normals(), vertex_inds, n_regions)
+        return self._normalize_orientations(orientations, counts)[regions_inverse]
 
     def compute_centers_for_regions(self, regions, surface, region_mapping) -> numpy.ndarray:
-        region_centers = numpy.zeros((len(regions), 3))
-        for i, k in enumerate(regions):
-            vert = surface.vertices[numpy.array(region_mapping) == k, :]
-            if vert.shape[0] > 0:
-                region_centers[i, :] = numpy.mean(vert, axis=0)
-
-        return region_centers
+        vertex_inds, regions_inverse, n_regions = self._region_vertex_indices(regions, region_mapping)
+        return self._grouped_region_means(surface.vertices, vertex_inds, n_regions)[0][regions_inverse]
@@ -7,18 +7,161 @@ import scipy.ndimage
 from tvb.recon.dax import AtlasSuffix
 import nibabel
 from tvb.recon.logger import get_logger
-from tvb.recon.algo.service.utils import execute_command
 from tvb.recon.algo.service.annotation import AnnotationService
+from tvb.recon.algo.service.blockwise import BlockwiseExecutor
 from tvb.recon.io.factory import IOUtils
+from tvb.recon.model.label_index import LabelIndex
 from tvb.recon.model.volume import Volume
 from tvb.recon.model.constants import NPY_EXTENSION
 
 
+def _relabel_block(label_data: numpy.ndarray, table: tuple, default: Union[int, float]) -> numpy.ndarray:
+    if not numpy.issubdtype(label_data.dtype, numpy.integer):
+        # Non integer values, including NaN, are not labels and get the default value
+        is_label = label_data == numpy.floor(label_data)
+        block_out = _relabel_block(numpy.where(is_label, label_data, 0).astype('int64'), table, default)
+        return numpy.where(is_label, block_out, default)
+
+    mode = table[0]
+    if mode == "lut":
+        # Lookup array indexed by label - min_label
+        _, lut, min_label = table
+        if min_label == 0:
+            return lut[label_data]
+        return lut[label_data - min_label]
+
+    # Sorted labels and their values, binary searched
+    _, table_labels, table_values = table
+    inds = numpy.searchsorted(table_labels, label_data).clip(max=table_labels.size - 1)
+    return numpy.where(table_labels[inds] == label_data, table_values[inds], default)
+
+
+def _face_neighbors_differ_block(data: numpy.ndarray) -> numpy.ndarray:
+    differ = numpy.zeros(data.shape, dtype='bool')
+    for axis in range(data.ndim):
+        lower = [slice(None)] * data.ndim
+        upper = [slice(None)] * data.ndim
+        lower[axis] = slice(None, -1)
+        upper[axis] = slice(1, None)
+        lower, upper = tuple(lower), tuple(upper)
+        different = data[lower] != data[upper]
+        differ[lower] |= different
+        differ[upper] |= different
+    return differ
+
+
+def _dilate_block(mask: numpy.ndarray, vn: int) -> numpy.ndarray:
+    return scipy.ndimage.maximum_filter(mask.astype('uint8'), size=2 * vn + 1, mode='constant', cval=0).astype('bool')
+
+
 class VolumeService(object):
     logger = get_logger(__name__)
 
-    def __init__(self):
+    # Largest label range mapped with a lookup array in relabel, beyond it labels are binary searched
+    _RELABEL_MAX_LUT_SIZE = 2 ** 24
+    # Number of voxels relabelled at once
+    _RELABEL_SLAB_VOXELS = 2 ** 22
+
+    def __init__(self, n_jobs: int=1):
+        """
+        :param n_jobs: number of processes used by the blockwise volume operations
+        """
         self.annotation_service = AnnotationService()
+        self.executor = BlockwiseExecutor(n_jobs)
+
+    def compact_label_dtype(self, values: Union[numpy.ndarray, list]) -> numpy.dtype:
+        """
+        Find the smallest dtype that holds the given label values exactly: the smallest integer dtype of their range
+        if they are all integers, otherwise float32 if it represents them exactly, or float64.
+        :param values: the values of a label volume, including its background value, or just their range
+        :return: numpy.dtype
+        """
+        values = numpy.asarray(values)
+        if values.size == 0:
+            return numpy.dtype('uint8')
+        if numpy.issubdtype(values.dtype, numpy.integer) or \
+                (numpy.all(numpy.isfinite(values)) and numpy.all(values == numpy.floor(values))):
+            min_value, max_value = int(values.min()), int(values.max())
+            for dtype in ('uint8', 'int8', 'uint16', 'int16', 'uint32', 'int32', 'uint64'):
+                if numpy.iinfo(dtype).min <= min_value and max_value <= numpy.iinfo(dtype).max:
+                    return numpy.dtype(dtype)
+            return numpy.dtype('int64')
+        if numpy.array_equal(values.astype('float32'), values, equal_nan=True):
+            return numpy.dtype('float32')
+        return numpy.dtype('float64')
+
+    def relabel(self, label_data: numpy.ndarray, labels: Union[numpy.ndarray, list],
+                values: Union[numpy.ndarray, list], default: Union[int, float]=0,
+                dtype: Optional[Union[str, numpy.dtype]]=None, out: Optional[numpy.ndarray]=None,
+                unmatched: Optional[set]=None) -> numpy.ndarray:
+        """
+        Map a label volume through a label -> value table, in one pass over the voxels.
+        The table is a lookup array indexed by the label values, or, when the labels are too sparse for that,
+        a sorted array of labels that is binary searched. The volume is processed in slabs along its first axis,
+        so that temporary arrays stay bounded.
+        :param label_data: array of integer labels, of any shape
+        :param labels: the labels of the table
+        :param values: the value to assign to the voxels of each label, one per label
+        :param default: the value of the voxels whose label is not in the table
+        :param dtype: the dtype of the output array, by default the one of values, or of out if given
+        :param out: array of the same shape as label_data to write the output to. It can be label_data itself
+        :param unmatched: if given, the values of the voxels that are not in the table are added to this set,
+                          slab by slab in the same pass. The slabs are then processed in this process
+        :return: array of the same shape as label_data
+        """
+        labels = numpy.array(labels).astype('int64')
+        values = numpy.array(values)
+        if out is None:
+            out = numpy.empty(label_data.shape, dtype=values.dtype if dtype is None else dtype)
+        if label_data.size == 0 or labels.size == 0:
+            if unmatched is not None:
+                unmatched.update(numpy.unique(label_data).tolist())
+            out[...] = default
+            return out
+
+        integer_data = numpy.issubdtype(label_data.dtype, numpy.integer)
+        if integer_data:
+            min_label, max_label = int(label_data.min()), int(label_data.max())
+        else:
+            # Non integer values, including NaN, are not labels and will get the default value
+            min_label, max_label = numpy.nanmin(label_data), numpy.nanmax(label_data)
+            if numpy.isnan(min_label):
+                if unmatched is not None:
+                    unmatched.update(numpy.unique(label_data).tolist())
+                out[...] = default
+                return out
+            min_label, max_label = int(numpy.floor(min_label)), int(numpy.ceil(max_label))
+        min_label = min(min_label, 0)
+
+        table = self._relabel_table(labels, values, default, out.dtype, min_label, max_label)
+
+        slab_length = max(1, self._RELABEL_SLAB_VOXELS // max(1, int(numpy.prod(label_data.shape[1:]))))
+        if unmatched is not None:
+            matched_table = self._relabel_table(labels, numpy.ones(labels.shape, dtype='bool'), False, 'bool',
+                                                min_label, max_label)
+            for start in range(0, label_data.shape[0], slab_length):
+                block = label_data[start:start + slab_length]
+                # Before writing the output, which can be label_data itself
+                unmatched.update(numpy.unique(block[~_relabel_block(block, matched_table, False)]).tolist())
+                out[start:start + slab_length] = _relabel_block(block, table, default)
+            return out
+
+        if self.executor.n_jobs > 1:
+            slab_length = min(slab_length, int(numpy.ceil(label_data.shape[0] / self.executor.n_jobs)))
+        self.executor.run(_relabel_block, label_data, args=(table, default), out=out, block_length=slab_length)
+
+        return out
+
+    def _relabel_table(self, labels: numpy.ndarray, values: numpy.ndarray, default: Union[int, float],
+                       dtype: Union[str, numpy.dtype], min_label: int, max_label: int) -> tuple:
+        if max_label - min_label < self._RELABEL_MAX_LUT_SIZE:
+            lut = numpy.full((max_label - min_label + 1,), default, dtype=dtype)
+            in_range = (labels >= min_label) & (labels <= max_label)
+            lut[labels[in_range] - min_label] = values[in_range]
+            return "lut", lut, min_label
+        # The last value of a repeated label wins, as for the lookup array
+        table_labels, last_inds = numpy.unique(labels[::-1], return_index=True)
+        return "sorted", table_labels, values[::-1][last_inds]
 
     def gen_label_volume_from_labels_inds(self, values: Union[numpy.ndarray, list],
                                           input_label_volume_file: os.PathLike, output_label_volume_file: os.PathLike) \
@@ -31,13 +174,8 @@ class VolumeService(object):
         label_nii = nibabel.load(input_label_volume_file)
         label_volume = label_nii.get_data()
 
-        new_volume = numpy.zeros(label_volume.shape)
-        new_volume[:, :] = numpy.nan
-
-        for i, value in enumerate(values):
-            region = i + 1
-            mask = label_volume[:, :, :] == region
-            new_volume[mask] = value
+        new_volume = self.relabel(label_volume, numpy.r_[1:len(values) + 1], values, default=numpy.nan,
+                                  dtype=self.compact_label_dtype(numpy.r_[values, numpy.nan]))
 
         # TODO: I don't know what this is... I have to ask Viktor...
         def add_min_max(volume):
@@ -55,7 +193,7 @@ class VolumeService(object):
                                      coords: Union[os.PathLike, numpy.ndarray],
                                      labels: Union[os.PathLike, numpy.ndarray, list], ref_volume_file: os.PathLike,
                                      out_volume_file: os.PathLike, skip_missing: bool=False, dist: int=0) \
-            -> numpy.ndarray:
+            -> Volume:
         """
         # Create and save a new nifti label volume of similar shape to a reference volume
         # by setting input values at input positions (optionally + & - (int) dist)
@@ -68,9 +206,10 @@ class VolumeService(object):
         :param out_volume_file: file path for the output nifti volume to be written
         :param skip_missing: flag
         :param dist: integer indicating the size of the neighborhood around the coords' positions to be labeled
-        :return: output nifti volume
+        :return: the written Volume
         """
         ref_volume = nibabel.load(ref_volume_file)
+        values = numpy.asarray(values)
 
         if os.path.isfile(str(labels)):
             labels = list(numpy.genfromtxt(labels, dtype=str, usecols=(0,)))
@@ -79,16 +218,14 @@ class VolumeService(object):
 
         if os.path.isfile(str(coords)):
             coords = numpy.genfromtxt(coords, dtype=float, usecols=(1, 2, 3))
+        coords = numpy.asarray(coords)
 
-        positions = numpy.zeros((len(values), 3))
+        # Each label takes the coordinates of its first occurrence
+        first_index = {}
         for i, label in enumerate(labels):
-            try:
-                contact_ind = labels.index(label)
-                coord = coords[contact_ind, :]
-            except ValueError:
-                coord = numpy.array([numpy.nan, numpy.nan, numpy.nan])
-
-            positions[i, :] = coord
+            first_index.setdefault(label, i)
+        positions = numpy.zeros((len(values), 3))
+        positions[:len(labels), :] = coords[[first_index[label] for label in labels], :]
 
         missing_mask = numpy.isnan(positions[:, 0])
         if skip_missing:
@@ -99,32 +236,116 @@ class VolumeService(object):
                 raise ValueError("Missing contact position(s) for: %s." % ", ".join([
                     name for name, missing in zip(labels, missing_mask) if missing]))
 
-            # numpy.array(names)[missing_mask]))
-
-        new_volume = numpy.zeros(ref_volume.shape)
+        shape = ref_volume.shape[:3]
+        new_volume = numpy.zeros(ref_volume.shape, dtype=self.compact_label_dtype(numpy.r_[values, 0]))
         # TODO: Find out the use of the following commented line:
         # new_volume[:, :] = numpy.nan
 
-        kx, ky, kz = numpy.mgrid[-dist:dist + 1, -dist:dist + 1, -dist:dist + 1]
-
-        for val, pos in zip(values, positions):
-            ix, iy, iz = numpy.linalg.solve(ref_volume.affine, numpy.append(pos, 1.0))[0:3].astype(int)
-            # new_volume[inds[0], inds[1], inds[2]] = val
-            new_volume[ix + kx, iy + ky, iz + kz] = val
+        # Transform all positions to voxel indices with a single solve against the affine
+        inds = numpy.linalg.solve(ref_volume.affine, numpy.c_[positions, numpy.ones((positions.shape[0],))].T)
+        inds = inds[0:3].T.astype(int)
+
+        # Stamp a (2 * dist + 1)^3 cube around each position, clipped at the volume borders
+        offsets = numpy.mgrid[-dist:dist + 1, -dist:dist + 1, -dist:dist + 1].reshape(3, -1).T
+        stamp_inds = (inds[:, numpy.newaxis, :] + offsets[numpy.newaxis, :, :]).reshape(-1, 3)
+        stamp_values = numpy.repeat(values, offsets.shape[0])
+        inside = numpy.all((stamp_inds >= 0) & (stamp_inds < shape), axis=1)
+        flat_inds = numpy.ravel_multi_index(stamp_inds[inside].T, shape)
+        stamp_values = stamp_values[inside]
+        # Where cubes overlap, the later position wins, as if they were stamped one after the other
+        _, last = numpy.unique(flat_inds[::-1], return_index=True)
+        last = flat_inds.size - 1 - last
+        new_volume[numpy.unravel_index(flat_inds[last], shape)] = stamp_values[last]
 
         # add_min_max(new_volume)
 
-        new_nii = nibabel.Nifti1Image(new_volume, ref_volume.affine)
-        nibabel.save(new_nii, out_volume_file)
+        new_volume = Volume(new_volume, ref_volume.affine, None)
+        IOUtils.write_volume(out_volume_file, new_volume)
+
+        return new_volume
+
+    def _face_neighbors_differ(self, data: numpy.ndarray) -> numpy.ndarray:
+        """
+        Mark the voxels that have at least one common-face neighbor of a different value.
+        Neighbors that would fall outside the image are ignored.
+        :param data: 3D array of labels
+        :return: boolean array of the same shape as data
+        """
+        return self.executor.run(_face_neighbors_differ_block, data, halo=1)
 
-        return nibabel.nifti1.Nifti1Image
+    def _target_label_voxels(self, data: numpy.ndarray, labels: Union[numpy.ndarray, list]) \
+            -> (numpy.ndarray, numpy.ndarray):
+        """
+        Find the voxels of all target labels in one pass.
+        :param data: 3D array of labels
+        :param labels: list of target labels
+        :return: array (number of voxels x 3) of the voxels' indexes, sorted by the position of their label in labels,
+                 and, for each voxel, that position
+        """
+        labels = numpy.array(labels)
+        voxels_ijk = numpy.argwhere(numpy.isin(data, labels))
+        voxels_labels = data[voxels_ijk[:, 0], voxels_ijk[:, 1], voxels_ijk[:, 2]]
+        # The first occurrence of each label wins, as with labels.index():
+        labels_order = numpy.argsort(labels, kind='stable')
+        voxels_index = labels_order[numpy.searchsorted(labels[labels_order], voxels_labels)]
+        voxels_order = numpy.argsort(voxels_index, kind='stable')
+        return voxels_ijk[voxels_order], voxels_index[voxels_order]
+
+    def _read_volume_input(self, volume: Union[os.PathLike, Volume]) -> Volume:
+        if isinstance(volume, Volume):
+            return volume
+        return IOUtils.read_volume(volume)
+
+    def _output_volume(self, volume: Volume, out: Optional[numpy.ndarray]=None, in_place: bool=False) -> Volume:
+        """
+        Get the output volume of an operation that changes some of the voxels of the input volume.
+        :param volume: the input volume
+        :param out: preallocated array for the output data, of the shape of the input data, which is copied into it
+        :param in_place: if True, the input data is used as output data. It cannot be combined with out.
+                         Read-only input data, e.g. read while the IOUtils read cache is enabled, is copied instead
+        :return: a Volume with the input affine matrix and header, holding the output data
+        """
+        if in_place and out is not None:
+            raise ValueError("Only one of out and in_place can be given!")
+        if in_place and not volume.data.flags.writeable:
+            self.logger.warning("The input data is read-only, so it is copied instead of being changed in place.")
+            in_place = False
+        if in_place:
+            out = volume.data
+        elif out is None:
+            out = numpy.array(volume.data)
+        elif out is not volume.data:
+            out[...] = volume.data
+        return Volume(out, volume.affine_matrix, volume.header)
+
+    def _write_volume_and_indexes(self, out_volume: Volume, out_ijk: numpy.ndarray,
+                                  out_vol_path: Optional[os.PathLike], in_vol_path: Union[os.PathLike, Volume]):
+        if out_vol_path is None:
+            if isinstance(in_vol_path, Volume):
+                raise ValueError("An output volume path is needed to write a volume that was not read from a file.")
+            out_vol_path = in_vol_path
+
+        IOUtils.write_volume(out_vol_path, out_volume)
+
+        # Save the output indexes
+        filepath = os.path.splitext(out_vol_path)[0]
+        numpy.save(filepath + "-idx.npy", out_ijk)
+        numpy.savetxt(filepath + "-idx.txt", out_ijk, fmt='%d')
 
-    def vol_to_ext_surf_vol(self, in_vol_path: os.PathLike, labels: Optional[Union[numpy.ndarray, list]]=None,
+    def vol_to_ext_surf_vol(self, in_vol_path: Union[os.PathLike, Volume],
+                            labels: Optional[Union[numpy.ndarray, list]]=None,
                             ctx: Optional[os.PathLike]=None, out_vol_path: Optional[os.PathLike]=None,
-                            labels_surf: Optional[Union[numpy.ndarray, list]]=None, labels_inner: str='0'):
+                            labels_surf: Optional[Union[numpy.ndarray, list]]=None, labels_inner: str='0',
+                            out: Optional[numpy.ndarray]=None, in_place: bool=False, write: bool=True) \
+            -> (Volume, numpy.ndarray):
         """
         Separate the voxels of the outer surface of a structure, from the inner ones. Default behavior: surface voxels
         retain their label, inner voxels get the label 0, and the input file is overwritten by the output.
+        :param in_vol_path: path to the input volume, or the input Volume itself
+        :param out: preallocated array for the output data
+        :param in_place: if True, change the input data instead of a copy of it. It cannot be combined with out
+        :param write: if False, do not write the output volume and indexes
+        :return: the output Volume and the indexes of the surface voxels
         """
 
         labels = self.annotation_service.read_input_labels(
@@ -161,82 +382,49 @@ class VolumeService(object):
             labels_inner = labels_inner.tolist()
 
         # Read the input volume...
-        volume = IOUtils.read_volume(in_vol_path)
+        volume = self._read_volume_input(in_vol_path)
 
-        # Neigbors' grid sharing a face
-        eye3 = numpy.identity(3)
-        border_grid = numpy.c_[eye3, -eye3].T.astype('i')
-        n_border = 6
+        # Find, in one pass over the whole volume, the voxels that have at least one common-face neighbor
+        # of a different label. These are the exterior surface voxels of every structure.
+        exterior = self._face_neighbors_differ(volume.data)
 
-        out_volume = Volume(numpy.array(volume.data),
-                            volume.affine_matrix, volume.header)
+        # Get the indexes of all voxels of the target labels, visited label by label, in the same order as
+        # numpy.where would return them for each label separately:
+        label_voxels_ijk, label_voxels_index = self._target_label_voxels(volume.data, labels)
+        label_voxels_exterior = exterior[label_voxels_ijk[:, 0], label_voxels_ijk[:, 1], label_voxels_ijk[:, 2]]
 
-        # Initialize output indexes
-        out_ijk = []
-
-        for label_index in range(number_of_labels):
-            current_label = labels[label_index]
-            # Get the indexes of all voxels of this label:
-            label_volxels_i, label_voxels_j, label_voxels_k = numpy.where(
-                volume.data == current_label)
-            # and for each voxel
-            for voxel_index in range(label_volxels_i.size):
-                # indexes of this voxel:
-                current_voxel_i, current_voxel_j, current_voxel_k = \
-                    label_volxels_i[voxel_index], label_voxels_j[
-                        voxel_index], label_voxels_k[voxel_index]
-                # Create the neighbors' grid sharing a face
-                ijk_grid = border_grid + \
-                           numpy.tile(numpy.array(
-                               [current_voxel_i, current_voxel_j, current_voxel_k]), (n_border, 1))
-                # Remove voxels outside the image
-                indices_inside_image = numpy.all([(ijk_grid[:, 0] >= 0), (ijk_grid[:, 0] < volume.dimensions[0]),
-                                                  (ijk_grid[:, 1] >= 0), (ijk_grid[
-                                                                          :, 1] < volume.dimensions[1]),
-                                                  (ijk_grid[:, 2] >= 0), (ijk_grid[:, 2] < volume.dimensions[2])],
-                                                 axis=0)
-                ijk_grid = ijk_grid[indices_inside_image, :]
-                try:
-                    # If all face neighbors are of the same label...
-                    if numpy.all(volume.data[ijk_grid[:, 0], ijk_grid[:, 1], ijk_grid[:, 2]] == numpy.tile(
-                            volume.data[current_voxel_i,
-                                        current_voxel_j, current_voxel_k],
-                            (n_border, 1))):
-                        # ...set this voxel to the corresponding inner target label
-                        out_volume.data[current_voxel_i, current_voxel_j,
-                                        current_voxel_k] = labels_inner[label_index]
-                    else:
-                        # ...set this voxel to the corresponding surface target label
-                        out_volume.data[current_voxel_i, current_voxel_j,
-                                        current_voxel_k] = labels_surf[label_index]
-                        out_ijk.append(
-                            [current_voxel_i, current_voxel_j, current_voxel_k])
-                except ValueError:  # empty grid
-                    self.logger.error("Error at voxel ( %s, %s, %s ) of label %s: It appears to have no common-face "
-                                      "neighbors inside the image!", str(
-                        current_voxel_i), str(current_voxel_j),
-                                      str(current_voxel_k), str(current_label))
-                    return
+        out_volume = self._output_volume(volume, out, in_place)
 
-        if out_vol_path is None:
-            out_vol_path = in_vol_path
+        # Set exterior voxels to the corresponding surface target label, and inner ones to the inner target label
+        labels_surf = numpy.array(labels_surf).astype(out_volume.data.dtype)
+        labels_inner = numpy.array(labels_inner).astype(out_volume.data.dtype)
+        out_volume.data[label_voxels_ijk[:, 0], label_voxels_ijk[:, 1], label_voxels_ijk[:, 2]] = numpy.where(
+            label_voxels_exterior, labels_surf[label_voxels_index], labels_inner[label_voxels_index])
 
-        IOUtils.write_volume(out_vol_path, out_volume)
+        # Initialize output indexes
+        out_ijk = label_voxels_ijk[label_voxels_exterior]
 
-        # save the output indexes that survived masking
-        out_ijk = numpy.vstack(out_ijk)
-        filepath = os.path.splitext(out_vol_path)[0]
-        numpy.save(filepath + "-idx.npy", out_ijk)
-        numpy.savetxt(filepath + "-idx.txt", out_ijk, fmt='%d')
+        if write:
+            self._write_volume_and_indexes(out_volume, out_ijk, out_vol_path, in_vol_path)
 
-    def mask_to_vol(self, in_vol_path: os.PathLike, mask_vol_path: os.PathLike,
+        return out_volume, out_ijk
+
+    def mask_to_vol(self, in_vol_path: Union[os.PathLike, Volume], mask_vol_path: Union[os.PathLike, Volume],
                     out_vol_path: Optional[os.PathLike]=None, labels: Optional[Union[numpy.ndarray, list]]=None,
                     ctx: Optional[str]=None, vol2mask_path: Optional[os.PathLike]=None, vn: int=1, th: float=0.999,
-                    labels_mask: Optional[os.PathLike]=None, labels_nomask: str='0'):
+                    labels_mask: Optional[os.PathLike]=None, labels_nomask: str='0',
+                    out: Optional[numpy.ndarray]=None, in_place: bool=False, write: bool=True) \
+            -> (Volume, numpy.ndarray):
         """
         Identify the voxels that are neighbors within a voxel distance vn, to a mask volume, with a mask threshold of th
         Default behavior: we assume a binarized mask and set th=0.999, no neighbors search, only looking at the exact
         voxel position, i.e., vn=0. Accepted voxels retain their label, whereas rejected ones get a label of 0
+        :param in_vol_path: path to the input volume, or the input Volume itself
+        :param mask_vol_path: path to the mask volume, or the mask Volume itself
+        :param out: preallocated array for the output data
+        :param in_place: if True, change the input data instead of a copy of it. It cannot be combined with out
+        :param write: if False, do not write the output volume and indexes
+        :return: the output Volume and the indexes of the accepted voxels
         """
 
         # Set the target labels:
@@ -277,9 +465,9 @@ class VolumeService(object):
         else:
             labels_nomask = labels_nomask.tolist()
 
-        volume = IOUtils.read_volume(in_vol_path)
+        volume = self._read_volume_input(in_vol_path)
 
-        mask_vol = IOUtils.read_volume(mask_vol_path)
+        mask_vol = self._read_volume_input(mask_vol_path)
 
         # Compute the transform from vol ijk to mask ijk:
         ijk2ijk = numpy.identity(4)
@@ -292,114 +480,65 @@ class VolumeService(object):
             ijk2ijk = volume.affine_matrix.dot(
                 numpy.dot(xyz2xyz, numpy.linalg.inv(mask_vol.affine_matrix)))
 
-        # Construct a grid template of voxels +/- vn voxels around each ijk
-        # voxel, sharing at least a corner
-        grid = numpy.meshgrid(list(range(-vn, vn + 1, 1)), list(
-            range(-vn, vn + 1, 1)), list(range(-vn, vn + 1, 1)), indexing='ij')
-        grid = numpy.c_[numpy.array(grid[0]).flatten(), numpy.array(
-            grid[1]).flatten(), numpy.array(grid[2]).flatten()]
-        n_grid = grid.shape[0]
+        # Threshold the mask once, and, if vn>0, dilate it by +/- vn voxels, so that each voxel of the dilated mask
+        # tells whether any of the voxels sharing at least a corner within a distance vn is a mask voxel:
+        mask = mask_vol.data >= th
+        if vn > 0:
+            mask = self.executor.run(_dilate_block, mask, halo=vn, args=(vn,))
 
-        out_volume = Volume(numpy.array(volume.data),
-                            volume.affine_matrix, volume.header)
+        # Get the indexes of all voxels of the target labels, visited label by label:
+        label_voxels_ijk, label_voxels_index = self._target_label_voxels(volume.data, labels)
 
-        # Initialize output indexes
-        out_ijk = []
-
-        # For each target label:
-        for label_index in range(number_of_labels):
-            current_label = labels[label_index]
-            # Get the indexes of all voxels of this label:
-            label_voxels_i, label_voxels_j, label_voxels_k = numpy.where(
-                volume.data == current_label)
-
-            for voxel_index in range(label_voxels_i.size):
-                current_voxel_i, current_voxel_j, current_voxel_k = \
-                    label_voxels_i[voxel_index], label_voxels_j[
-                        voxel_index], label_voxels_k[voxel_index]
-                # TODO if necessary: deal with voxels at the edge of the image, such as brain stem ones...
-                #     if any([(i==0), (i==mask_shape[0]-1),(j==0), (j==mask_shape[0]-1),(k==0), (k==mask_shape[0]-1)]):
-                #               mask_shape[i,j,k]=0
-                #               continue
-
-                # ...get the corresponding voxel in the mask volume:
-                ijk = numpy.round(ijk2ijk.dot(numpy.array(
-                    [current_voxel_i, current_voxel_j, current_voxel_k, 1]))[:3]).astype('i')
-
-                # Make sure this point is within image limits
-                for cc in range(3):
-                    if ijk[cc] < 0:
-                        ijk[cc] = 0
-
-                    elif ijk[cc] >= mask_vol.dimensions[cc]:
-                        ijk[cc] = mask_vol.dimensions[cc] - 1
-
-                # If this is a voxel to keep, set it so...
-                if mask_vol.data[ijk[0], ijk[1], ijk[2]] >= th:
-                    out_volume.data[current_voxel_i, current_voxel_j,
-                                    current_voxel_k] = labels_mask[label_index]
-                    out_ijk.append(
-                        [current_voxel_i, current_voxel_j, current_voxel_k])
-
-                elif vn > 0:
-                    # If not, and as long as vn>0 check whether any of its vn neighbors is a mask voxel.
-                    # Generate the specific grid centered at the vertex ijk
-                    ijk_grid = grid + numpy.tile(ijk, (n_grid, 1))
-
-                    # Remove voxels outside the mask volume
-                    indexes_within_limits = numpy.all([(ijk_grid[:, 0] >= 0), (ijk_grid[:, 0] < mask_vol.dimensions[0]),
-                                                       (ijk_grid[:, 1] >= 0), (ijk_grid[
-                                                                               :, 1] < mask_vol.dimensions[1]),
-                                                       (ijk_grid[:, 2] >= 0),
-                                                       (ijk_grid[:, 2] < mask_vol.dimensions[2])],
-                                                      axis=0)
-                    ijk_grid = ijk_grid[indexes_within_limits, :]
-
-                    try:
-                        # If none of these points is a mask point:
-                        if (mask_vol.data[ijk_grid[:, 0], ijk_grid[
-                                                          :, 1], ijk_grid[:, 2]] < th).all():
-                            out_volume.data[
-                                current_voxel_i, current_voxel_j, current_voxel_k] = labels_nomask[label_index]
-
-                        else:  # if any of them is a mask point:
-                            out_volume.data[
-                                current_voxel_i, current_voxel_j, current_voxel_k] = labels_mask[label_index]
-                            out_ijk.append(
-                                [current_voxel_i, current_voxel_j, current_voxel_k])
-
-                    except ValueError:  # empty grid
-                        self.logger.error("Error at voxel ( %s, %s, %s ): It appears to have no common-face neighbors "
-                                          "inside the image!", str(
-                            current_voxel_i), str(current_voxel_j),
-                                          str(current_voxel_k))
-                        return
-
-                else:
-                    out_volume.data[current_voxel_i, current_voxel_j,
-                                    current_voxel_k] = labels_nomask[label_index]
+        out_volume = self._output_volume(volume, out, in_place)
 
-        if out_vol_path is None:
-            out_vol_path = in_vol_path
+        # TODO if necessary: deal with voxels at the edge of the image, such as brain stem ones...
+        #     if any([(i==0), (i==mask_shape[0]-1),(j==0), (j==mask_shape[0]-1),(k==0), (k==mask_shape[0]-1)]):
+        #               mask_shape[i,j,k]=0
+        #               continue
 
-        IOUtils.write_volume(out_vol_path, out_volume)
+        # ...get the corresponding voxels in the mask volume, all at once:
+        mask_ijk = numpy.round(label_voxels_ijk.dot(ijk2ijk[:3, :3].T) + ijk2ijk[:3, 3]).astype('i')
 
-        # Save the output indexes that survived masking
-        out_ijk = numpy.vstack(out_ijk)
-        filepath = os.path.splitext(out_vol_path)[0]
-        numpy.save(filepath + "-idx.npy", out_ijk)
-        numpy.savetxt(filepath + "-idx.txt", out_ijk, fmt='%d')
+        # Make sure these points are within image limits
+        mask_ijk = numpy.clip(mask_ijk, 0, numpy.array(mask_vol.dimensions[:3]) - 1)
+
+        # Keep the voxels that correspond to a (dilated) mask voxel, and reject the rest:
+        label_voxels_keep = mask[mask_ijk[:, 0], mask_ijk[:, 1], mask_ijk[:, 2]]
+        labels_mask = numpy.array(labels_mask).astype(out_volume.data.dtype)
+        labels_nomask = numpy.array(labels_nomask).astype(out_volume.data.dtype)
+        out_volume.data[label_voxels_ijk[:, 0], label_voxels_ijk[:, 1], label_voxels_ijk[:, 2]] = numpy.where(
+            label_voxels_keep, labels_mask[label_voxels_index], labels_nomask[label_voxels_index])
+
+        # Initialize output indexes
+        out_ijk = label_voxels_ijk[label_voxels_keep]
+
+        if write:
+            self._write_volume_and_indexes(out_volume, out_ijk, out_vol_path, in_vol_path)
 
-    def vol_val_xyz(self, vol: numpy.ndarray, aff: numpy.ndarray, val: float) -> numpy.ndarray:
-        vox_idx = numpy.argwhere(vol == val)
+        return out_volume, out_ijk
+
+    def vol_val_xyz(self, vol: numpy.ndarray, aff: numpy.ndarray, val: float,
+                    label_index: Optional[LabelIndex]=None) -> numpy.ndarray:
+        """
+        :param vol: label volume data
+        :param aff: voxel to world transform of the volume
+        :param val: the label value
+        :param label_index: LabelIndex of vol, to avoid scanning the volume when called for many values
+        :return: world coordinates of the voxels of value val, numpy.ndarray of shape (n_voxels, 3)
+        """
+        if label_index is None:
+            vox_idx = numpy.argwhere(vol == val)
+        else:
+            vox_idx = label_index.voxels(val)
         xyz = aff.dot(numpy.c_[vox_idx, numpy.ones(vox_idx.shape[0])].T)[:3].T
         return xyz
 
-    def compute_label_volume_centers(self, label_volume: numpy.ndarray, affine: numpy.ndarray):
+    def compute_label_volume_centers(self, label_volume: numpy.ndarray, affine: numpy.ndarray,
+                                     label_index: Optional[LabelIndex]=None):
+        if label_index is None:
+            label_index = LabelIndex(label_volume)
 
-        for val in numpy.unique(label_volume):
-            xyz = self.vol_val_xyz(label_volume, affine, val)
-            x, y, z = xyz.mean(axis=0)
+        for val, (x, y, z) in zip(label_index.labels, label_index.centers(affine)):
             yield val, (x, y, z)
 
     def label_with_dilation(self, to_label_nii_fname: os.PathLike, dilated_nii_fname: os.PathLike,
@@ -417,14 +556,15 @@ class VolumeService(object):
         lab, n = scipy.ndimage.label(dil_mask.data)
 
         # TODO: this change is from tvb-make. Keep it or not? It returns a different result than the old version.
-        lab_xyz = list(self.compute_label_volume_centers(lab, dil_mask.affine_matrix))
+        label_index = LabelIndex(lab)
         lab_sort = numpy.r_[:n + 1]
         # sort labels along AP axis
-        for i, (val, _) in enumerate(sorted(lab_xyz, key=lambda t: t[1][1])):
-            lab_sort[val] = i
-        lab = lab_sort[lab]
+        ap_order = numpy.argsort(label_index.centers(dil_mask.affine_matrix)[:, 1], kind='stable')
+        lab_sort[label_index.labels[ap_order]] = numpy.r_[:len(label_index)]
+        lab = self.relabel(lab, numpy.r_[:n + 1], lab_sort)
 
-        mask.data *= lab
+        labeled_mask = mask.data * lab
+        mask.data = labeled_mask.astype(self.compact_label_dtype(labeled_mask), copy=False)
         self.logger.info(
             '%d objects found when labeling the dilated volume.', n)
 
@@ -432,9 +572,8 @@ class VolumeService(object):
 
     def _label_config(self, aparc: nibabel.nifti1.Nifti1Image) -> nibabel.nifti1.Nifti1Image:
         unique_data = numpy.unique(aparc.data)
-        unique_data_map = numpy.r_[:unique_data.max() + 1]
-        unique_data_map[unique_data] = numpy.r_[:unique_data.size]
-        aparc.data = unique_data_map[aparc.data]
+        aparc.data = self.relabel(aparc.data, unique_data, numpy.r_[:unique_data.size],
+                                  dtype=self.compact_label_dtype([0, unique_data.size - 1]))
         return aparc
 
     def simple_label_config(self, in_aparc_path: os.PathLike, out_volume_path: os.PathLike):
@@ -450,8 +589,10 @@ class VolumeService(object):
 
     def _label_volume(self, tdi_volume: nibabel.nifti1.Nifti1Image, lo: float=0.5) -> nibabel.nifti1.Nifti1Image:
         mask = tdi_volume.data > lo
-        tdi_volume.data[~mask] = 0
-        tdi_volume.data[mask] = numpy.r_[1:mask.sum() + 1]
+        n_labels = mask.sum()
+        labels = numpy.zeros(mask.shape, dtype=self.compact_label_dtype([0, n_labels]))
+        labels[mask] = numpy.r_[1:n_labels + 1]
+        tdi_volume.data = labels
         return tdi_volume
 
     def label_vol_from_tdi(self, tdi_volume_path: os.PathLike, out_volume_path: os.PathLike, lo: float=0.5):
@@ -467,6 +608,18 @@ class VolumeService(object):
         tdi_volume = self._label_volume(nii_volume, lo)
         IOUtils.write_volume(out_volume_path, tdi_volume)
 
+    def _read_connectivity_matrix(self, matrix_path: os.PathLike) -> numpy.ndarray:
+        # Keep the stored dtype of .npy matrices, e.g. float tract lengths
+        if os.path.splitext(str(matrix_path))[1] == NPY_EXTENSION:
+            return numpy.load(matrix_path)
+        return numpy.array(numpy.genfromtxt(matrix_path, dtype='int64'))
+
+    def _write_connectivity_matrix(self, matrix_path: os.PathLike, matrix: numpy.ndarray):
+        matrix_path_root, matrix_path_extension = os.path.splitext(str(matrix_path))
+        numpy.save(matrix_path_root + NPY_EXTENSION, matrix)
+        if matrix_path_extension != NPY_EXTENSION:
+            numpy.savetxt(matrix_path, matrix, fmt='%1d')
+
     def remove_zero_connectivity_nodes(self, node_volume_path: os.PathLike, connectivity_matrix_path: os.PathLike,
                                        tract_length_path: Optional[str]=None):
         """
@@ -474,15 +627,15 @@ class VolumeService(object):
         The zero connectivity nodes will be labeled with 0 in the volume and the remaining labels will be updated.
         The connectivity matrices will be symmetric.
         :param node_volume_path: tdi_lbl.nii volume path
-        :param connectivity_matrix_path: .csv file, output of Mrtrix3 tck2connectome
-        :param tract_length_path: optional .csv tract lengths matrix
+        :param connectivity_matrix_path: .csv file, output of Mrtrix3 tck2connectome, or .npy file.
+                                         Matrices in .npy files are read and written only in binary format
+        :param tract_length_path: optional .csv or .npy tract lengths matrix
         :return: overwrites the input volume and matrices with the processed ones. Also saves matrices as .npy.
         """
 
         node_volume = IOUtils.read_volume(node_volume_path)
 
-        connectivity = numpy.array(numpy.genfromtxt(
-            connectivity_matrix_path, dtype='int64'))
+        connectivity = self._read_connectivity_matrix(connectivity_matrix_path)
         connectivity = connectivity + connectivity.T
         connectivity_row_sum = numpy.sum(connectivity, axis=0)
 
@@ -490,31 +643,22 @@ class VolumeService(object):
         connectivity = connectivity[nodes_to_keep_indices, :][
                        :, nodes_to_keep_indices]
 
-        numpy.save(os.path.splitext(connectivity_matrix_path)
-                   [0] + NPY_EXTENSION, connectivity)
-        numpy.savetxt(connectivity_matrix_path, connectivity, fmt='%1d')
+        self._write_connectivity_matrix(connectivity_matrix_path, connectivity)
 
         if os.path.exists(str(tract_length_path)):
-            connectivity = numpy.array(numpy.genfromtxt(
-                tract_length_path, dtype='int64'))
+            connectivity = self._read_connectivity_matrix(tract_length_path)
             connectivity = connectivity[nodes_to_keep_indices, :][
                            :, nodes_to_keep_indices]
 
-            numpy.save(os.path.splitext(tract_length_path)
-                       [0] + NPY_EXTENSION, connectivity)
-            numpy.savetxt(tract_length_path, connectivity, fmt='%1d')
+            self._write_connectivity_matrix(tract_length_path, connectivity)
 
         else:
             self.logger.warning("Path %s is not valid.", tract_length_path)
 
-        nodes_to_remove_indices, = numpy.where(~nodes_to_keep_indices)
-        nodes_to_remove_indices += 1
-
-        for node_index in nodes_to_remove_indices:
-            node_volume.data[node_volume.data == node_index] = 0
-
-        node_volume.data[node_volume.data > 0] = numpy.r_[
-                                                 1:(connectivity.shape[0] + 1)]
+        # Node i + 1 of the volume becomes the rank of node i among the kept ones, or 0 if it is removed
+        new_node_labels = numpy.cumsum(nodes_to_keep_indices) * nodes_to_keep_indices
+        node_volume.data = self.relabel(node_volume.data, numpy.r_[1:nodes_to_keep_indices.size + 1],
+                                        new_node_labels, dtype=self.compact_label_dtype([0, connectivity.shape[0]]))
 
         IOUtils.write_volume(node_volume_path, node_volume)
 
@@ -539,45 +683,91 @@ class VolumeService(object):
         return vox, voxxzy
 
     def change_labels_of_aparc_aseg(self, atlas_suffix, volume, mapping_dict, conn_regs_nr):
+        labels = numpy.array(list(mapping_dict.keys()), dtype='int64')
+        values = numpy.array(list(mapping_dict.values()))
+        renamed_labels = {}
         if atlas_suffix == AtlasSuffix.A2009S:
-            volume.data[volume.data == 1000] = 11100
-            volume.data[volume.data == 2000] = 12100
+            # The voxels of 1000 and 2000 are mapped as 11100 and 12100, through the table instead of the volume
+            renamed_labels = {1000: 11100, 2000: 12100}
+            kept = ~numpy.in1d(labels, list(renamed_labels.keys()))
+            labels, values = labels[kept], values[kept]
+            for label, renamed_label in renamed_labels.items():
+                if renamed_label in mapping_dict:
+                    labels = numpy.r_[labels, label]
+                    values = numpy.r_[values, mapping_dict[renamed_label]]
         not_matched = set()
-        for i in range(volume.data.shape[0]):
-            for j in range(volume.data.shape[1]):
-                for k in range(volume.data.shape[2]):
-                    val = volume.data[i][j][k]
-                    if not val in mapping_dict:
-                        not_matched.add(val)
-                    volume.data[i][j][k] = mapping_dict.get(val, -1)
+        # Keep the dtype of the input volume, unless it cannot hold the new labels
+        dtype = numpy.promote_types(volume.data.dtype, self.compact_label_dtype(numpy.r_[values, -1]))
+        volume.data = self.relabel(volume.data, labels, values, default=-1, dtype=dtype, unmatched=not_matched)
+        not_matched = set(renamed_labels.get(label, label) for label in not_matched)
 
-        print("Now values are in interval [%d - %d]" % (volume.data.min(), volume.data.max()))
+        self.logger.info("Now values are in interval [%d - %d]", volume.data.min(), volume.data.max())
 
         if not_matched:
-            print("Not matched regions will be considered background: %s" % not_matched)
+            self.logger.info("Not matched regions will be considered background: %s", not_matched)
         assert (volume.data.min() >= -1 and volume.data.max() < conn_regs_nr)
 
         return volume
 
-    def transform_coords(self, coords: Union[list, numpy.ndarray, str], src_img: os.PathLike, dest_img: os.PathLike,
-                  transform_mat: os.PathLike, output_file: Optional[str]=None) \
-            -> (numpy.array, Union[numpy.ndarray, type(None)]):
+    def _fsl_scaled_voxel_transform(self, image: nibabel.spatialimages.SpatialImage) -> numpy.ndarray:
+        """
+        FLIRT matrices act on FSL scaled voxel coordinates, i.e., voxel indices multiplied by the voxel sizes,
+        with the x axis flipped for images in neurological orientation (positive determinant of the affine).
+        :param image: the nibabel image, only its header is used
+        :return: the voxel to FSL scaled voxel transform, numpy.ndarray of shape (4, 4)
+        """
+        scaled_voxel_transform = numpy.diag(list(image.header.get_zooms()[:3]) + [1.0])
+        if numpy.linalg.det(image.affine[:3, :3]) > 0:
+            flip_x = numpy.eye(4)
+            flip_x[0, 0] = -1
+            flip_x[0, 3] = image.shape[0] - 1
+            scaled_voxel_transform = scaled_voxel_transform.dot(flip_x)
+        return scaled_voxel_transform
+
+    def compute_flirt_world_transform(self, src_img: os.PathLike, dest_img: os.PathLike,
+                                      transform_mat: os.PathLike) -> numpy.ndarray:
+        """
+        Compute the world (mm) to world (mm) transform that a FLIRT matrix applies between two images,
+        as FSL img2imgcoord -mm does.
+        :param src_img: path to the source image of the FLIRT registration
+        :param dest_img: path to the destination image of the FLIRT registration
+        :param transform_mat: path to the FLIRT .mat file
+        :return: numpy.ndarray of shape (4, 4)
+        """
+        src_image = nibabel.load(src_img)
+        dest_image = nibabel.load(dest_img)
+        flirt_matrix = numpy.loadtxt(transform_mat)
 
-        if os.path.isfile(coords):
-            command = "img2imgcoord %s -mm -src %s -dest %s -xfm %s"
-            args = [coords, src_img, dest_img, transform_mat]
-        else:
-            coords_str = " ".join([str(x) for x in coords])
-            command = "echo %s | img2imgcoord -mm -src %s -dest %s -xfm %s"
-            args = [coords_str, src_img, dest_img, transform_mat]
+        src_world_to_scaled = self._fsl_scaled_voxel_transform(src_image).dot(numpy.linalg.inv(src_image.affine))
+        dest_scaled_to_world = dest_image.affine.dot(numpy.linalg.inv(self._fsl_scaled_voxel_transform(dest_image)))
+
+        return dest_scaled_to_world.dot(flirt_matrix).dot(src_world_to_scaled)
 
-        if os.path.isdir(os.path.dirname(output_file)):
-            command += " > %s"
-            args.append(output_file)
+    def transform_coords(self, coords: Union[list, numpy.ndarray, str], src_img: os.PathLike, dest_img: os.PathLike,
+                         transform_mat: os.PathLike, output_file: Optional[str]=None) \
+            -> (numpy.array, Union[str, type(None)]):
+        """
+        Transform mm coordinates from a source to a destination image with a FLIRT matrix, in process,
+        giving the same results as FSL img2imgcoord -mm.
+        :param coords: coordinates as numpy.ndarray of shape (3, ) or (n_coords, 3), or file to read them from
+        :param src_img: path to the source image of the FLIRT registration
+        :param dest_img: path to the destination image of the FLIRT registration
+        :param transform_mat: path to the FLIRT .mat file
+        :param output_file: optional file to write the transformed coordinates to, in img2imgcoord output format
+        :return: the transformed coordinates, with the shape of the input coordinates, and the output file
+        """
+        if os.path.isfile(str(coords)):
+            coords = numpy.loadtxt(coords, ndmin=2)
+        coords = numpy.array(coords, dtype='float64')
 
-        output, std_out, time = \
-            execute_command(command % tuple(args), cwd=os.path.dirname(transform_mat), shell=True)
+        world_transform = self.compute_flirt_world_transform(src_img, dest_img, transform_mat)
+        coords_2d = coords.reshape((-1, 3))
+        transformed_coords = coords_2d.dot(world_transform[:3, :3].T) + world_transform[:3, 3]
 
-        transformed_coords_str = output.strip().split('\n')[-1]
+        if output_file is not None and os.path.isdir(os.path.dirname(os.path.abspath(output_file))):
+            with open(output_file, "w") as fl:
+                fl.write("Coordinates in Destination volume (in mm)\n")
+                for coord in transformed_coords:
+                    fl.write("%g  %g  %g  \n" % tuple(coord))
 
-        return numpy.array([float(x) for x in transformed_coords_str.split(" ") if x]), output_file
+        return transformed_coords.reshape(coords.shape), output_file
@@ -1,13 +1,123 @@
 # -*- coding: utf-8 -*-
 
+import copy
 import os
+import threading
+from collections import OrderedDict
+import numpy
 from tvb.recon.io.annotation import H5AnnotationIO, AnnotationIO
 from tvb.recon.io.surface import GiftiSurfaceIO, FreesurferIO, H5SurfaceIO, ZipSurfaceIO, BrainVisaIO
 from tvb.recon.io.volume import VolumeIO, H5VolumeIO
 from tvb.recon.model.constants import GIFTI_EXTENSION, H5_EXTENSION
 
 
+class ReadCache(object):
+    """
+    LRU cache of the objects read from files, keyed on the kind of object, the file path,
+    its modification time and size, and the read arguments, so that a changed file is read again.
+
+    The arrays of the objects read while the cache is enabled are made read-only, whether the objects fit
+    in the memory budget or not. Each read gets its own copy of the object, which shares these arrays
+    with the cached object but has deep copies of its other attributes (names, metadata, headers),
+    so callers can replace or edit those, but not change the cached data in place.
+    """
+
+    def __init__(self, max_bytes: int):
+        """
+        :param max_bytes: memory budget, as the total size of the arrays of the cached objects
+        """
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._n_bytes = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(kind, file_path, args):
+        file_stat = os.stat(file_path)
+        return (kind, os.path.abspath(file_path), file_stat.st_mtime_ns, file_stat.st_size) + tuple(args)
+
+    @staticmethod
+    def _arrays(obj):
+        return [value for value in vars(obj).values() if isinstance(value, numpy.ndarray)]
+
+    @staticmethod
+    def _copy(obj):
+        # Share the read-only arrays, copy everything else
+        obj_copy = copy.copy(obj)
+        for name, value in vars(obj).items():
+            if not isinstance(value, numpy.ndarray):
+                setattr(obj_copy, name, copy.deepcopy(value))
+        return obj_copy
+
+    def read(self, kind, read_function, file_path, *args):
+        key = self._key(kind, file_path, args)
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return self._copy(self._entries[key][0])
+
+        obj = read_function(file_path, *args)
+        arrays = self._arrays(obj)
+        for array in arrays:
+            array.flags.writeable = False
+        n_bytes = sum(array.nbytes for array in arrays)
+        if n_bytes > self.max_bytes:
+            return obj
+
+        with self._lock:
+            if key not in self._entries:
+                self._entries[key] = (obj, n_bytes)
+                self._n_bytes += n_bytes
+                while self._n_bytes > self.max_bytes:
+                    _, (_, evicted_n_bytes) = self._entries.popitem(last=False)
+                    self._n_bytes -= evicted_n_bytes
+        return self._copy(obj)
+
+    def invalidate(self, file_path):
+        file_path = os.path.abspath(file_path)
+        with self._lock:
+            for key in [key for key in self._entries if key[1] == file_path]:
+                _, n_bytes = self._entries.pop(key)
+                self._n_bytes -= n_bytes
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._n_bytes = 0
+
+
 class IOUtils(object):
+    # Process-wide read cache, disabled unless enable_read_cache is called
+    read_cache = None
+
+    @staticmethod
+    def enable_read_cache(max_bytes=2 ** 30):
+        """
+        Cache the volumes, surfaces and annotations read by IOUtils, within a memory budget (1 GiB by default).
+        The arrays of the objects read while the cache is enabled are read-only, and shared with later reads
+        of the same file. Code that changes them in place, e.g. surface.vertices[i] = ... or
+        volume.data[mask] = ..., fails with a ValueError, and has to copy the arrays first,
+        or replace them (volume.data = ...) as the services do. The other attributes, such as the region names,
+        metadata and headers, are copied for each read.
+        Lazy volumes are not cached, since their data is read from the file when accessed.
+        """
+        IOUtils.read_cache = ReadCache(max_bytes)
+
+    @staticmethod
+    def disable_read_cache():
+        IOUtils.read_cache = None
+
+    @staticmethod
+    def __read(kind, read_function, file_path, *args):
+        if IOUtils.read_cache is None:
+            return read_function(file_path, *args)
+        return IOUtils.read_cache.read(kind, read_function, file_path, *args)
+
+    @staticmethod
+    def __invalidate(file_path):
+        if IOUtils.read_cache is not None:
+            IOUtils.read_cache.invalidate(file_path)
+
     @staticmethod
     def __get_extension(file_path):
         _, extension = os.path.splitext(file_path)
@@ -32,12 +142,13 @@ class IOUtils(object):
     @staticmethod
     def read_surface(surface_path, use_center_surface):
         surface_io = IOUtils.surface_io_factory(surface_path)
-        return surface_io.read(surface_path, use_center_surface)
+        return IOUtils.__read("surface", surface_io.read, surface_path, use_center_surface)
 
     @staticmethod
     def write_surface(out_surface_path, surface):
         surface_io = IOUtils.surface_io_factory(out_surface_path)
         surface_io.write(surface, out_surface_path)
+        IOUtils.__invalidate(out_surface_path)
 
     @staticmethod
     def volume_io_factory(volume_path):
@@ -49,14 +160,18 @@ class IOUtils(object):
             return VolumeIO()
 
     @staticmethod
-    def read_volume(volume_path):
+    def read_volume(volume_path, lazy=False):
         volume_io = IOUtils.volume_io_factory(volume_path)
-        return volume_io.read(volume_path)
+        if lazy:
+            # The data of a lazy volume is only read when accessed, out of the memory budget of the cache
+            return volume_io.read(volume_path, lazy)
+        return IOUtils.__read("volume", volume_io.read, volume_path, lazy)
 
     @staticmethod
     def write_volume(out_volume_path, volume):
         volume_io = IOUtils.volume_io_factory(out_volume_path)
         volume_io.write(out_volume_path, volume)
+        IOUtils.__invalidate(out_volume_path)
 
     @staticmethod
     def annotation_io_factory(annotation_path):
@@ -70,9 +185,10 @@ class IOUtils(object):
     @staticmethod
     def read_annotation(annotation_path):
         annotation_io = IOUtils.annotation_io_factory(annotation_path)
-        return annotation_io.read(annotation_path)
+        return IOUtils.__read("annotation", annotation_io.read, annotation_path)
 
     @staticmethod
     def write_annotation(out_annotation_path, annotation):
         annotation_io = IOUtils.annotation_io_factory(out_annotation_path)
         annotation_io.write(out_annotation_path, annotation)
+        IOUtils.__invalidate(out_annotation_path)
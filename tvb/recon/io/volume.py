@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
 
+import numpy
 import nibabel
 import h5py
 from tvb.recon.logger import get_logger
@@ -11,7 +12,7 @@ class ABCVolumeIO(object):
     This will define the behaviour needed for a volume io.
     """
 
-    def read(self, volume_path):
+    def read(self, volume_path, lazy=False):
         raise NotImplementedError()
 
     def write(self, out_volume_path, volume):
@@ -25,19 +26,30 @@ class VolumeIO(ABCVolumeIO):
 
     logger = get_logger(__name__)
 
-    def read(self, volume_path):
+    def read(self, volume_path, lazy=False):
+        """
+        :param volume_path: path to the NIFTI file
+        :param lazy: if True, keep the nibabel array proxy instead of reading the data,
+                     which will be read, or memory mapped for uncompressed files, only when accessed
+        """
         image = nibabel.load(volume_path)
         header = image.header
-        data = image.get_data()
         affine_matrix = image.affine
         self.logger.info("The affine matrix extracted from volume %s is %s" % (
             volume_path, affine_matrix))
 
+        if lazy:
+            return Volume(None, affine_matrix, header, data_proxy=image.dataobj)
+
+        data = image.get_data()
         return Volume(data, affine_matrix, header)
 
     def write(self, out_volume_path, volume):
         image = nibabel.Nifti1Image(
             volume.data, volume.affine_matrix, volume.header)
+        if numpy.issubdtype(volume.data.dtype, numpy.integer):
+            # Store integer (label) data with its own dtype rather than with the one of the header it came with
+            image.set_data_dtype(volume.data.dtype)
         nibabel.save(image, out_volume_path)
 
 
@@ -48,7 +60,8 @@ class H5VolumeIO(ABCVolumeIO):
 
     logger = get_logger(__name__)
 
-    def read(self, volume_path):
+    def read(self, volume_path, lazy=False):
+        # H5 volumes are always read entirely
         h5_file = h5py.File(volume_path, 'r', libver='latest')
         data = h5_file['/data'][()]
         h5_file.close()
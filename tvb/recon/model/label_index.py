@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+
+import numpy
+
+
+class LabelIndex(object):
+    """
+    Index of the voxels of each label of a label volume.
+
+    It is built with a single stable sort of the voxels by label, so that the voxels, counts,
+    bounding boxes and centroids of all labels come from one pass over the volume,
+    instead of one scan of the volume per label.
+    """
+
+    def __init__(self, data: numpy.ndarray):
+        self.shape = data.shape
+        flat_data = data.ravel()
+        # flat indices of the voxels sorted by label, in C order within each label
+        self._order = numpy.argsort(flat_data, kind='stable')
+        sorted_data = flat_data[self._order]
+        if sorted_data.size > 0:
+            self._starts = numpy.r_[0, numpy.flatnonzero(sorted_data[1:] != sorted_data[:-1]) + 1]
+        else:
+            self._starts = numpy.array([], dtype='i')
+        self.labels = sorted_data[self._starts]  # sorted unique labels
+        self.counts = numpy.diff(numpy.r_[self._starts, sorted_data.size])  # number of voxels per label
+        self._bounding_boxes = None
+        self._centroids = None
+
+    def __len__(self) -> int:
+        return self.labels.size
+
+    def __contains__(self, label) -> bool:
+        return self._label_position(label) is not None
+
+    def _label_position(self, label):
+        position = numpy.searchsorted(self.labels, label)
+        if position < self.labels.size and self.labels[position] == label:
+            return position
+        return None
+
+    def count(self, label) -> int:
+        position = self._label_position(label)
+        if position is None:
+            return 0
+        return int(self.counts[position])
+
+    def voxels(self, label) -> numpy.ndarray:
+        """
+        :param label: a label value
+        :return: voxel indices of the label, in the same order as numpy.argwhere, numpy.ndarray of shape (n_voxels, ndim)
+        """
+        position = self._label_position(label)
+        if position is None:
+            return numpy.zeros((0, len(self.shape)), dtype='i')
+        start = self._starts[position]
+        flat_inds = self._order[start:start + self.counts[position]]
+        return numpy.array(numpy.unravel_index(flat_inds, self.shape)).T
+
+    def _reduce_voxel_coords(self):
+        # Reduce one axis at a time, to hold a single coordinate per voxel in memory
+        n_dims = len(self.shape)
+        self._bounding_boxes = numpy.zeros((self.labels.size, 2, n_dims), dtype='i')
+        self._centroids = numpy.zeros((self.labels.size, n_dims))
+        if self.labels.size == 0:
+            return
+        for axis in range(n_dims):
+            axis_stride = int(numpy.prod(self.shape[axis + 1:]))
+            axis_coords = (self._order // axis_stride) % self.shape[axis]
+            self._bounding_boxes[:, 0, axis] = numpy.minimum.reduceat(axis_coords, self._starts)
+            self._bounding_boxes[:, 1, axis] = numpy.maximum.reduceat(axis_coords, self._starts)
+            self._centroids[:, axis] = numpy.add.reduceat(axis_coords, self._starts) / self.counts
+
+    @property
+    def bounding_boxes(self) -> numpy.ndarray:
+        """
+        :return: minimum and maximum (inclusive) voxel indices of each label, numpy.ndarray of shape (n_labels, 2, ndim)
+        """
+        if self._bounding_boxes is None:
+            self._reduce_voxel_coords()
+        return self._bounding_boxes
+
+    @property
+    def centroids(self) -> numpy.ndarray:
+        """
+        :return: mean voxel indices of each label, numpy.ndarray of shape (n_labels, ndim)
+        """
+        if self._centroids is None:
+            self._reduce_voxel_coords()
+        return self._centroids
+
+    def centers(self, affine: numpy.ndarray) -> numpy.ndarray:
+        """
+        :param affine: voxel to world transform of the volume
+        :return: world coordinates of the centroid of each label, numpy.ndarray of shape (n_labels, 3)
+        """
+        centroids = self.centroids
+        affine = numpy.asarray(affine, dtype='float64')
+        return centroids.dot(affine[:3, :3].T) + affine[:3, 3]
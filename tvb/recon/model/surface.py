@@ -2,22 +2,46 @@
 
 from typing import Union, Optional
 import numpy
+from scipy.sparse import csr_matrix
 from tvb.recon.model.constants import *
 from trimesh import Trimesh, intersections
 #from tvb.recon.algo.service.surface import  SurfaceService
 
 
+def triangle_edges(triangles: numpy.ndarray, n_vertices: int, directed: bool=False) -> numpy.ndarray:
+    """
+    Computes the unique edges of a mesh from its triangles, by encoding each pair of vertex indexes
+    as a single integer, so that repetitions are removed with a single numpy.unique.
+    :param triangles: triangles array (number of triangles x 3)
+    :param n_vertices: number of vertices of the mesh
+    :param directed: if True, (i, j) and (j, i) are different edges,
+                     otherwise each edge is returned once, as (min(i, j), max(i, j))
+    :return: the edges, sorted, numpy.ndarray of shape (number of edges, 2)
+    """
+    edges = numpy.r_[triangles[:, [0, 1]], triangles[:, [1, 2]], triangles[:, [2, 0]]].astype(numpy.int64)
+    if not directed:
+        edges.sort(axis=1)
+    edge_codes = numpy.unique(edges[:, 0] * n_vertices + edges[:, 1])
+    return numpy.c_[edge_codes // n_vertices, edge_codes % n_vertices]
+
+
 class Surface(object):
     """
     Hold a surface mesh (vertices and triangles).
 
     Has also few methods to read from this mesh (e.g. a contour cut).
+
+    The mesh topology (vertex -> triangle incidence, edges, adjacency) and the triangle areas are computed
+    on first use and cached. The caches are reset when the vertices or triangles are replaced
+    (the topology only if the number of vertices changes), so these arrays should not be modified in place.
     """
 
     def __init__(self, vertices: numpy.ndarray, triangles: numpy.ndarray,
                  area_mask: Optional[Union[numpy.ndarray, list]]=None, center_ras: Union[numpy.ndarray, list]=[],
                  vertices_coord_system=None, generic_metadata=None, vertices_metadata=None, triangles_metadata=None):
         # TODO: clarify the args' types
+        self._topology = {}
+        self._geometry = {}
         if len(vertices) == 0:
             self.vertices = numpy.empty((0, 3))
         else:
@@ -32,9 +56,6 @@ class Surface(object):
 
         self.center_ras = center_ras  # [x, y, z]
 
-        self.n_vertices = self.vertices.shape[0]
-        self.n_triangles = self.triangles.shape[0]
-
         self.generic_metadata = generic_metadata
         self.vertices_metadata = vertices_metadata
         self.triangles_metadata = triangles_metadata
@@ -46,6 +67,64 @@ class Surface(object):
         else:
             self.area_mask = area_mask
 
+    @property
+    def vertices(self) -> numpy.ndarray:
+        return self._vertices
+
+    @vertices.setter
+    def vertices(self, vertices: numpy.ndarray):
+        # The shapes of the incidence and adjacency matrices depend on the number of vertices
+        if getattr(self, "n_vertices", None) != vertices.shape[0]:
+            self._topology = {}
+        self._vertices = vertices
+        self.n_vertices = vertices.shape[0]
+        self._geometry = {}
+
+    @property
+    def triangles(self) -> numpy.ndarray:
+        return self._triangles
+
+    @triangles.setter
+    def triangles(self, triangles: numpy.ndarray):
+        self._triangles = triangles
+        self.n_triangles = triangles.shape[0]
+        self._topology = {}
+        self._geometry = {}
+
+    def get_vertex_triangle_incidence(self) -> csr_matrix:
+        """
+        :return: sparse matrix (number of vertices x number of triangles), of 1 for each triangle of a vertex,
+                 the row of a vertex holding its triangles in increasing order
+        """
+        if "incidence" not in self._topology:
+            incidence = csr_matrix((numpy.ones((self.triangles.size,), dtype='i'),
+                                    (self.triangles.ravel(), numpy.repeat(numpy.arange(self.n_triangles), 3))),
+                                   shape=(self.n_vertices, self.n_triangles))
+            # Count a vertex repeated in a degenerate triangle once
+            incidence.data[:] = 1
+            self._topology["incidence"] = incidence
+        return self._topology["incidence"]
+
+    def get_edges(self) -> numpy.ndarray:
+        """
+        :return: unique undirected edges, as (min(i, j), max(i, j)), numpy.ndarray of shape (number of edges, 2)
+        """
+        if "edges" not in self._topology:
+            self._topology["edges"] = triangle_edges(self.triangles, self.n_vertices)
+            self._topology["edges"].flags.writeable = False
+        return self._topology["edges"]
+
+    def get_adjacency(self) -> csr_matrix:
+        """
+        :return: symmetric sparse matrix (number of vertices x number of vertices), of 1 for each edge
+        """
+        if "adjacency" not in self._topology:
+            edges = self.get_edges()
+            edges = numpy.r_[edges, edges[edges[:, 0] != edges[:, 1]][:, [1, 0]]]
+            self._topology["adjacency"] = csr_matrix((numpy.ones((edges.shape[0],)), (edges[:, 0], edges[:, 1])),
+                                                     shape=(self.n_vertices, self.n_vertices))
+        return self._topology["adjacency"]
+
     def get_main_metadata(self):
         if self.vertices_metadata is not None:
             return self.vertices_metadata
@@ -64,11 +143,9 @@ class Surface(object):
                                   new_triangles + self.n_vertices]
         self.vertices = numpy.r_[self.vertices, new_vertices]
         n_new_vertices = new_vertices.shape[0]
-        self.n_vertices += n_new_vertices
-        self.n_triangles += new_triangles.shape[0]
         if len(new_area_mask) == 0:
             new_area_mask = numpy.ones((n_new_vertices,), dtype='bool')
-        numpy.r_[self.area_mask, new_area_mask]
+        self.area_mask = numpy.r_[self.area_mask, new_area_mask]
         # self.stack_vertices_and_triangles()
 
     # def stack_vertices_and_triangles(self):
@@ -109,52 +186,56 @@ class Surface(object):
     #         (vertices,triangles) = surface_service.extract_subsurf(self,self.area_mask,output="verts_triangls")[:2]
     #     return numpy.sum(surface_service.tri_area(vertices[triangles]))
 
-    def compute_normals(self) -> numpy.ndarray:
-        """
-        :return: array of triangle normal vectors
-        """
-        normals = [[0, 0, 0] for _ in range(len(self.triangles))]
+    def _float_vertices(self, dtype=None) -> numpy.ndarray:
+        if dtype is None:
+            dtype = self.vertices.dtype if numpy.issubdtype(self.vertices.dtype, numpy.floating) else numpy.float64
+        return self.vertices.astype(dtype, copy=False)
 
-        for i, tri in enumerate(self.triangles):
-            u = self.vertices[tri[1]] - self.vertices[tri[0]]
-            v = self.vertices[tri[2]] - self.vertices[tri[0]]
-            normals[i][0] = u[1] * v[2] - u[2] * v[1]
-            normals[i][1] = u[2] * v[0] - u[0] * v[2]
-            normals[i][2] = u[0] * v[1] - u[1] * v[0]
+    def _triangle_edge_vectors(self, dtype=None) -> (numpy.ndarray, numpy.ndarray):
+        # For each corner of each triangle, the vectors towards the next two corners
+        triangle_vertices = self._float_vertices(dtype)[self.triangles]
+        return (numpy.roll(triangle_vertices, -1, axis=1) - triangle_vertices,
+                numpy.roll(triangle_vertices, -2, axis=1) - triangle_vertices)
 
-        return normals
+    def compute_normals(self, dtype=None) -> numpy.ndarray:
+        """
+        :param dtype: floating point type of the computation, the one of the vertices by default
+        :return: array of triangle normal vectors, of norm twice the triangle area
+        """
+        vertices = self._float_vertices(dtype)
+        return numpy.cross(vertices[self.triangles[:, 1]] - vertices[self.triangles[:, 0]],
+                           vertices[self.triangles[:, 2]] - vertices[self.triangles[:, 0]])
 
-    def vertex_normals(self) -> numpy.ndarray:
+    def vertex_normals(self, weighting: str="area", dtype=None) -> numpy.ndarray:
+        """
+        :param weighting: "area" to weight the normals of the triangles of a vertex by the triangle areas,
+                          or "angle" to weight them by the inner angles of the triangles at the vertex
+        :param dtype: floating point type of the computation, the one of the vertices by default
+        :return: array of unit vertex normal vectors
+        """
         # TODO test by generating points on unit sphere: vtx pos should equal
         # normal
-
-        vf = self.vertices[self.triangles]
-        fn = numpy.cross(vf[:, 1] - vf[:, 0], vf[:, 2] - vf[:, 0])
-        vf = [set() for _ in range(len(self.vertices))]
-        for i, fi in enumerate(self.triangles):
-            for j in fi:
-                vf[j].add(i)
-        vn = numpy.zeros_like(self.vertices)
-        for i, fi in enumerate(vf):
-            fni = fn[list(fi)]
-            norm = fni.sum(axis=0)
-            norm /= numpy.sqrt((norm ** 2).sum())
-            vn[i] = norm
+        if weighting == "angle":
+            # Sum the unit normals of the triangles of each vertex, weighted by the angle at the vertex
+            triangle_normals = self._get_triangle_normals(dtype)
+            angle_weights = csr_matrix((self._get_triangle_angles(dtype).ravel(),
+                                        (self.triangles.ravel(), numpy.repeat(numpy.arange(self.n_triangles), 3))),
+                                       shape=(self.n_vertices, self.n_triangles))
+            vn = angle_weights.dot(triangle_normals).astype(triangle_normals.dtype)
+        else:
+            # Sum the normals of the triangles of each vertex, of norm proportional to the triangle area
+            triangle_normals = self.compute_normals(dtype)
+            vn = self.get_vertex_triangle_incidence().dot(triangle_normals).astype(triangle_normals.dtype)
+        vn /= numpy.sqrt((vn ** 2).sum(axis=1))[:, numpy.newaxis]
         return vn
 
     def get_vertex_triangles(self) -> list:
-        vertex_triangles = [[] for _ in range(self.n_vertices)]
-        for k in range(self.n_triangles):
-            vertex_triangles[self.triangles[k, 0]].append(k)
-            vertex_triangles[self.triangles[k, 1]].append(k)
-            vertex_triangles[self.triangles[k, 2]].append(k)
-        return vertex_triangles
-
-    def _get_triangle_normals(self) -> numpy.ndarray:
+        incidence = self.get_vertex_triangle_incidence()
+        return [triangles.tolist() for triangles in numpy.split(incidence.indices, incidence.indptr[1:-1])]
+
+    def _get_triangle_normals(self, dtype=None) -> numpy.ndarray:
         """Calculates triangle normals."""
-        tri_u = self.vertices[self.triangles[:, 1], :] - self.vertices[self.triangles[:, 0], :]
-        tri_v = self.vertices[self.triangles[:, 2], :] - self.vertices[self.triangles[:, 0], :]
-        tri_norm = numpy.cross(tri_u, tri_v)
+        tri_norm = self.compute_normals(dtype)
 
         try:
             triangle_normals = tri_norm / numpy.sqrt(numpy.sum(tri_norm ** 2, axis=1))[:, numpy.newaxis]
@@ -164,40 +245,46 @@ class Surface(object):
             triangle_normals = tri_norm
         return triangle_normals
 
-    def _get_triangle_angles(self) -> numpy.ndarray:
+    def _get_triangle_angles(self, dtype=None) -> numpy.ndarray:
         """
         Calculates the inner angles of all the triangles which make up a surface
+        :return: array (number of triangles x 3) of the angle at each vertex of each triangle
         """
-        verts = self.vertices
-        # TODO: Should be possible with arrays, ie not nested loops...
-        # A short profile indicates this function takes 95% of the time to compute normals
-        # (this was a direct translation of some old matlab code)
-        angles = numpy.zeros((self.n_triangles, 3))
-        for tt in range(self.n_triangles):
-            triangle = self.triangles[tt, :]
-            for ta in range(3):
-                ang = numpy.roll(triangle, -ta)
-                angles[tt, ta] = numpy.arccos(numpy.dot(
-                    (verts[ang[1], :] - verts[ang[0], :]) /
-                    numpy.sqrt(numpy.sum((verts[ang[1], :] - verts[ang[0], :]) ** 2, axis=0)),
-                    (verts[ang[2], :] - verts[ang[0], :]) /
-                    numpy.sqrt(numpy.sum((verts[ang[2], :] - verts[ang[0], :]) ** 2, axis=0))))
-
-        return angles
+        edges_next, edges_previous = self._triangle_edge_vectors(dtype)
+        edges_next /= numpy.sqrt(numpy.sum(edges_next ** 2, axis=2))[:, :, numpy.newaxis]
+        edges_previous /= numpy.sqrt(numpy.sum(edges_previous ** 2, axis=2))[:, :, numpy.newaxis]
+        # Clip the cosines to avoid NaNs from rounding errors in (almost) degenerate triangles
+        return numpy.arccos(numpy.clip(numpy.sum(edges_next * edges_previous, axis=2), -1.0, 1.0))
 
     def get_triangle_areas(self) -> numpy.ndarray:
         """Calculates the area of triangles making up a surface."""
-        tri_u = self.vertices[self.triangles[:, 1], :] - self.vertices[self.triangles[:, 0], :]
-        tri_v = self.vertices[self.triangles[:, 2], :] - self.vertices[self.triangles[:, 0], :]
-        tri_norm = numpy.cross(tri_u, tri_v)
-        triangle_areas = numpy.sqrt(numpy.sum(tri_norm ** 2, axis=1)) / 2.0
-        triangle_areas = triangle_areas[:, numpy.newaxis]
-        return triangle_areas
+        if "triangle_areas" not in self._geometry:
+            tri_u = self.vertices[self.triangles[:, 1], :] - self.vertices[self.triangles[:, 0], :]
+            tri_v = self.vertices[self.triangles[:, 2], :] - self.vertices[self.triangles[:, 0], :]
+            tri_norm = numpy.cross(tri_u, tri_v)
+            triangle_areas = numpy.sqrt(numpy.sum(tri_norm ** 2, axis=1)) / 2.0
+            self._geometry["triangle_areas"] = triangle_areas[:, numpy.newaxis]
+            self._geometry["triangle_areas"].flags.writeable = False
+        return self._geometry["triangle_areas"]
 
     def get_vertex_areas(self) -> numpy.ndarray:
-        triangle_areas = self.get_triangle_areas()
-        vertex_areas = numpy.zeros((self.vertices.shape[0]))
-        for triang, vertices in enumerate(self.triangles):
-            for i in range(3):
-                vertex_areas[vertices[i]] += 1. / 3. * triangle_areas[triang]
-        return vertex_areas
+        # A third of the area of each triangle goes to each of its vertices
+        if "vertex_areas" not in self._geometry:
+            triangle_areas = self.get_triangle_areas()[:, 0]
+            self._geometry["vertex_areas"] = numpy.bincount(self.triangles.ravel(),
+                                                            weights=numpy.repeat(triangle_areas / 3., 3),
+                                                            minlength=self.n_vertices)
+            self._geometry["vertex_areas"].flags.writeable = False
+        return self._geometry["vertex_areas"]
+
+    def get_masked_area(self, verts_mask: Optional[Union[numpy.ndarray, list]]=None) -> float:
+        """
+        Computes the area of the sub-surface of the triangles of which all 3 vertices are masked,
+        from the cached triangle areas, without extracting the sub-surface.
+        :param verts_mask: boolean mask (number of vertices x ), the area_mask of the surface by default
+        :return: the sub-surface area
+        """
+        if verts_mask is None:
+            verts_mask = self.area_mask
+        triangles_mask = numpy.asarray(verts_mask, dtype=bool)[self.triangles].all(axis=1)
+        return self.get_triangle_areas()[triangles_mask, 0].sum()
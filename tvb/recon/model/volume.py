@@ -1,6 +1,6 @@
 # -*- coding: utf-8 -*-
 
-from typing import Union
+from typing import Optional, Union
 import numpy
 import numpy.linalg
 from tvb.recon.model.constants import *
@@ -12,15 +12,50 @@ class Volume(object):
     Hold volume data, dimensions and affine matrix.
 
     Has a method that cuts a slice from the volume.
+
+    A lazy volume is given a data proxy (e.g. the nibabel image dataobj) instead of the data array.
+    The whole array is only read when data is first accessed, while read_slab reads just the requested part.
     """
 
-    def __init__(self, data: numpy.ndarray, affine_matrix: numpy.ndarray, header: str):
-        self.data = data  # 3D array
-        self.dimensions = data.shape  # array with the length of each data dimension
+    def __init__(self, data: Optional[numpy.ndarray], affine_matrix: numpy.ndarray, header: str,
+                 data_proxy: Optional[object]=None):
+        self._data = data  # 3D array
+        self._data_proxy = data_proxy
+        # array with the length of each data dimension
+        self.dimensions = data.shape if data is not None else tuple(data_proxy.shape)
         # matrix containing voxel to ras transformation
         self.affine_matrix = affine_matrix
         self.header = header
 
+    @property
+    def data(self) -> numpy.ndarray:
+        if self._data is None:
+            # Uncompressed files without scaling are memory mapped by the proxy
+            self._data = numpy.asanyarray(self._data_proxy)
+        return self._data
+
+    @data.setter
+    def data(self, data: numpy.ndarray):
+        self._data = data
+
+    def is_lazy(self) -> bool:
+        return self._data is None
+
+    def read_slab(self, slicer: tuple) -> numpy.ndarray:
+        """
+        Read a part of the data, without reading the whole array if the volume is lazy.
+        :param slicer: tuple of integers and slices
+        :return: the data of the slab
+        :raises IndexError: if an integer index is out of the volume, as for an array
+        """
+        for axis, index in enumerate(slicer):
+            if not isinstance(index, slice) and not -self.dimensions[axis] <= index < self.dimensions[axis]:
+                raise IndexError("Index %d is out of bounds for axis %d with size %d"
+                                 % (index, axis, self.dimensions[axis]))
+        if self._data is None:
+            return numpy.asanyarray(self._data_proxy[slicer])
+        return self._data[slicer]
+
     def get_center_point(self) -> numpy.ndarray:
         a = numpy.array(self.affine_matrix)
         b = numpy.array(list(numpy.divide(self.dimensions, 2)) + [1])
@@ -32,6 +67,7 @@ class Volume(object):
             -> (numpy.ndarray, numpy.ndarray, numpy.ndarray):
         """
         This determines slice colors and axes coordinates for the slice.
+        Only the slice is read from lazy volumes.
         :param projection: one of sagittal, axial or coronal
         :param ras: 3D point where to do the slicing
         :return: X, Y, 2D data matrix
@@ -41,24 +77,22 @@ class Volume(object):
         ijk_ras = numpy.round(apply_affine(affine_inverse, ras)).astype('i')
 
         slice_index_1, slice_index_2 = X_Y_INDEX[projection]
+        normal_index = 3 - slice_index_1 - slice_index_2
+        n_1, n_2 = self.dimensions[slice_index_1], self.dimensions[slice_index_2]
 
-        slice_data = numpy.zeros(
-            (self.dimensions[slice_index_1], self.dimensions[slice_index_2]))
-        x_axis_coords = numpy.zeros_like(slice_data)
-        y_axis_coords = numpy.zeros_like(slice_data)
-
-        for i in range(self.dimensions[slice_index_1]):
-            for j in range(self.dimensions[slice_index_2]):
-                ijk_ras[slice_index_1] = i
-                ijk_ras[slice_index_2] = j
-
-                ras_coordinates = apply_affine(self.affine_matrix, ijk_ras)
-                x_axis_coords[i, j] = ras_coordinates[slice_index_1]
-                y_axis_coords[i, j] = ras_coordinates[slice_index_2]
+        slicer = [slice(None)] * 3
+        slicer[normal_index] = ijk_ras[normal_index]
+        slice_data = self.read_slab(tuple(slicer))
+        if slice_index_1 > slice_index_2:
+            slice_data = numpy.swapaxes(slice_data, 0, 1)
+        # Keep the first value of volumes with more than 3 dimensions
+        slice_data = numpy.array(slice_data.reshape((n_1, n_2, -1))[:, :, 0], dtype='float64')
 
-                color = self.data[ijk_ras[0], ijk_ras[1], ijk_ras[2]]
-                if isinstance(color, (list, numpy.ndarray)):
-                    color = color[0]
-                slice_data[i][j] = color
+        ijk = numpy.zeros((n_1, n_2, 3), dtype='i')
+        ijk[:, :, normal_index] = ijk_ras[normal_index]
+        ijk[:, :, slice_index_1], ijk[:, :, slice_index_2] = numpy.mgrid[0:n_1, 0:n_2]
+        ras_coordinates = apply_affine(self.affine_matrix, ijk)
+        x_axis_coords = ras_coordinates[:, :, slice_index_1]
+        y_axis_coords = ras_coordinates[:, :, slice_index_2]
 
         return x_axis_coords, y_axis_coords, slice_data
@@ -28,13 +28,13 @@ class ImageProcessor(object):
 
     def read_t1_affine_matrix(self) -> np.ndarray:
         t1_volume = IOUtils.read_volume(os.path.join(
-            os.environ[MRI_DIRECTORY], os.environ[T1_RAS_VOLUME]))
+            os.environ[MRI_DIRECTORY], os.environ[T1_RAS_VOLUME]), lazy=True)
         return t1_volume.affine_matrix
 
     def show_single_volume(self, volume_path: os.PathLike, use_cc_point: bool,
                            snapshot_name: os.PathLike=SNAPSHOT_NAME):
 
-        volume = IOUtils.read_volume(volume_path)
+        volume = IOUtils.read_volume(volume_path, lazy=True)
 
         if use_cc_point:
             ras = self.generic_io.get_ras_coordinates(
@@ -59,8 +59,8 @@ class ImageProcessor(object):
     def overlap_2_volumes(self, background_path: os.PathLike, overlay_path: os.PathLike,
                           use_cc_point: bool, snapshot_name: str=SNAPSHOT_NAME):
 
-        background_volume = IOUtils.read_volume(background_path)
-        overlay_volume = IOUtils.read_volume(overlay_path)
+        background_volume = IOUtils.read_volume(background_path, lazy=True)
+        overlay_volume = IOUtils.read_volume(overlay_path, lazy=True)
 
         if use_cc_point:
             ras = self.generic_io.get_ras_coordinates(
@@ -90,9 +90,9 @@ class ImageProcessor(object):
                           overlay_2_path: os.PathLike, use_cc_point: bool,
                           snapshot_name: str=SNAPSHOT_NAME):
 
-        volume_background = IOUtils.read_volume(background_path)
-        volume_overlay_1 = IOUtils.read_volume(overlay_1_path)
-        volume_overlay_2 = IOUtils.read_volume(overlay_2_path)
+        volume_background = IOUtils.read_volume(background_path, lazy=True)
+        volume_overlay_1 = IOUtils.read_volume(overlay_1_path, lazy=True)
+        volume_overlay_2 = IOUtils.read_volume(overlay_2_path, lazy=True)
 
         if use_cc_point:
             ras = self.generic_io.get_ras_coordinates(
@@ -131,7 +131,7 @@ class ImageProcessor(object):
 
     def overlap_volume_surfaces(self, volume_background: os.PathLike, surfaces_path: os.PathLike,
                                 use_center_surface: bool, use_cc_point: bool, snapshot_name: str=SNAPSHOT_NAME):
-        volume = IOUtils.read_volume(volume_background)
+        volume = IOUtils.read_volume(volume_background, lazy=True)
 
         if use_cc_point:
             ras = self.generic_io.get_ras_coordinates(
@@ -182,7 +182,7 @@ class ImageProcessor(object):
 
         """
 
-        aparc_aseg_volume = IOUtils.read_volume(aparc_aseg_volume_path)
+        aparc_aseg_volume = IOUtils.read_volume(aparc_aseg_volume_path, lazy=True)
 
         fs_to_conn_indices_mapping = {}
         with open(fs_to_conn_indices_mapping_path, 'r') as fd:
@@ -204,7 +204,7 @@ class ImageProcessor(object):
 
         background_volume = None
         if background_volume_path:
-            background_volume = IOUtils.read_volume(background_volume_path)
+            background_volume = IOUtils.read_volume(background_volume_path, lazy=True)
 
         for projection in PROJECTIONS:
             self._aparc_aseg_projection(
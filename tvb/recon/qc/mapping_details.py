@@ -60,12 +60,11 @@ def compute_region_details(atlas_suffix: AtlasSuffix, fs_color_lut: os.PathLike,
     dict_fs_custom = mapping.get_mapping_for_connectome_generation()
     genericIO.write_dict_to_txt_file(dict_fs_custom, AsegFiles.FS_CUSTOM_TXT.value.replace("%s", atlas_suffix))
 
-    region_areas = surface_service.compute_areas_for_regions(mapping.get_all_regions(), cort_subcort_full_surf,
-                                                             cort_subcort_full_region_mapping)
+    region_areas, region_centers, region_orientations = \
+        surface_service.compute_region_statistics(mapping.get_all_regions(), cort_subcort_full_surf,
+                                                  cort_subcort_full_region_mapping)
     genericIO.write_list_to_txt_file(region_areas, AsegFiles.AREAS_TXT.value.replace("%s", atlas_suffix))
 
-    region_centers = surface_service.compute_centers_for_regions(mapping.get_all_regions(), cort_subcort_full_surf,
-                                                                 cort_subcort_full_region_mapping)
     cort_subcort_lut = mapping.get_entire_lut()
     region_names = list(cort_subcort_lut.values())
 
@@ -73,24 +72,16 @@ def compute_region_details(atlas_suffix: AtlasSuffix, fs_color_lut: os.PathLike,
         for idx, (val_x, val_y, val_z) in enumerate(region_centers):
             f.write("%s %.2f %.2f %.2f\n" % (region_names[idx], val_x, val_y, val_z))
 
-    region_orientations = surface_service.compute_orientations_for_regions(mapping.get_all_regions(),
-                                                                           cort_subcort_full_surf,
-                                                                           cort_subcort_full_region_mapping)
-
-    lh_region_centers = surface_service.compute_centers_for_regions(mapping.get_lh_regions(), surf_cort_lh,
-                                                                    mapping.lh_region_mapping)
-    lh_region_orientations = surface_service.compute_orientations_for_regions(mapping.get_lh_regions(), surf_cort_lh,
-                                                                              mapping.lh_region_mapping)
+    _, lh_region_centers, lh_region_orientations = \
+        surface_service.compute_region_statistics(mapping.get_lh_regions(), surf_cort_lh, mapping.lh_region_mapping)
     with open(AsegFiles.LH_DIPOLES_TXT.value.replace("%s", atlas_suffix), "w") as f:
         for idx, (val_x, val_y, val_z) in enumerate(lh_region_centers):
             f.write("%.2f %.2f %.2f %.2f %.2f %.2f\n" % (
                 val_x, val_y, val_z, lh_region_orientations[idx][0], lh_region_orientations[idx][1],
                 lh_region_orientations[idx][2]))
 
-    rh_region_centers = surface_service.compute_centers_for_regions(mapping.get_rh_regions(), surf_cort_rh,
-                                                                    mapping.rh_region_mapping)
-    rh_region_orientations = surface_service.compute_orientations_for_regions(mapping.get_rh_regions(), surf_cort_rh,
-                                                                              mapping.rh_region_mapping)
+    _, rh_region_centers, rh_region_orientations = \
+        surface_service.compute_region_statistics(mapping.get_rh_regions(), surf_cort_rh, mapping.rh_region_mapping)
     with open(AsegFiles.RH_DIPOLES_TXT.value.replace("%s", atlas_suffix), "w") as f:
         for idx, (val_x, val_y, val_z) in enumerate(rh_region_centers):
             f.write("%.2f %.2f %.2f %.2f %.2f %.2f\n" % (
@@ -19,3 +19,31 @@ def test_roi_areas():
     my_roi_areas = np.array([roi_area(i, vfm, v_roi)
                              for i in r_[1:35] if i != 3])
     assert np.testing.allclose(fs_roi_areas, my_roi_areas)
+
+
+def test_elec_pos_transform(tmp_path):
+    from tvb.recon.algo.elec_pos import transform
+    from tvb.recon.io.factory import IOUtils
+    from tvb.recon.model.volume import Volume
+
+    affine = np.array([[2, 0, 0, -10], [0, 2, 0, -12], [0, 0, 2, -14], [0, 0, 0, 1]])
+    volume_path = str(tmp_path / "t1.nii.gz")
+    IOUtils.write_volume(volume_path, Volume(np.zeros((10, 12, 14)), affine, None))
+    transform_mat = np.eye(4)
+    transform_mat[:3, 3] = [3, 4, 5]
+    transform_mat_path = str(tmp_path / "elec_to_t1.mat")
+    np.savetxt(transform_mat_path, transform_mat)
+    elec_file_pom = str(tmp_path / "seeg_pom.xyz")
+    with open(elec_file_pom, "w") as fl:
+        fl.write("A1 0 0 0\nA2 1.5 -2 7\n")
+
+    elec_file_t1 = str(tmp_path / "seeg.xyz")
+    elec_nii_t1 = str(tmp_path / "elec_t1.nii.gz")
+    transform(elec_file_pom, volume_path, volume_path, elec_file_t1, elec_nii_t1, transform_mat_path)
+
+    # the coordinates are written with their labels, without intermediate files
+    assert sorted(path.name for path in tmp_path.iterdir()) == \
+        ["elec_t1.nii.gz", "elec_to_t1.mat", "seeg.xyz", "seeg_pom.xyz", "t1.nii.gz"]
+    assert list(np.genfromtxt(elec_file_t1, dtype=str, usecols=(0,))) == ["A1", "A2"]
+    assert np.allclose(np.genfromtxt(elec_file_t1, usecols=(1, 2, 3)), [[-3, 4, 5], [-1.5, 2, 12]])
+    assert np.count_nonzero(IOUtils.read_volume(elec_nii_t1).data) > 0
@@ -28,7 +28,7 @@ def get_temporary_files_path(*args):
 
 
 def remove_temporary_test_files():
-    shutil.rmtree(temporary_folder)
+    shutil.rmtree(temporary_folder, ignore_errors=True)
 
 
 class BaseTest(unittest.TestCase):
@@ -2,10 +2,13 @@
 
 import os
 
+import numpy
 import pytest
 from nibabel.filebasedimages import ImageFileError
 
 from tvb.recon.io.factory import IOUtils
+from tvb.recon.model.constants import PROJECTIONS
+from tvb.recon.model.volume import Volume
 from tvb.recon.tests.base import get_data_file, get_temporary_files_path, remove_temporary_test_files
 
 TEST_MODIF_SUBJECT = 'fsaverage_modified'
@@ -51,3 +54,76 @@ def test_write_volume():
     out_file_path = get_temporary_files_path('T1-out.nii.gz')
     IOUtils.write_volume(out_file_path, volume)
     assert os.path.exists(out_file_path)
+
+
+def test_read_lazy_volume(tmp_path):
+    data = numpy.arange(4 * 5 * 6, dtype='int16').reshape((4, 5, 6))
+    affine = numpy.array([[-1, 0, 0, 2], [0, 1, 0, -3], [0, 0, 2, 1], [0, 0, 0, 1]])
+    file_path = str(tmp_path / 'lazy.nii')
+    IOUtils.write_volume(file_path, Volume(data, affine, None))
+
+    volume = IOUtils.read_volume(file_path, lazy=True)
+    assert volume.is_lazy()
+    assert volume.dimensions == (4, 5, 6)
+    assert numpy.array_equal(volume.affine_matrix, affine)
+    assert numpy.array_equal(volume.read_slab((1, slice(None), slice(2, 4))), data[1, :, 2:4])
+
+    eager_volume = IOUtils.read_volume(file_path)
+    for projection in PROJECTIONS:
+        for lazy_slice, eager_slice in zip(volume.slice_volume(projection, [1, -1, 5]),
+                                           eager_volume.slice_volume(projection, [1, -1, 5])):
+            assert numpy.array_equal(lazy_slice, eager_slice)
+    assert volume.is_lazy()
+
+    # a point out of the volume fails as for an eager volume, before reading from the proxy
+    for any_volume in [volume, eager_volume]:
+        for projection in PROJECTIONS:
+            with pytest.raises(IndexError):
+                any_volume.slice_volume(projection, [100, 100, 100])
+    assert volume.is_lazy()
+
+    assert numpy.array_equal(volume.data, data)
+    assert isinstance(volume.data, numpy.memmap)
+    assert not volume.is_lazy()
+
+
+def test_read_volume_cache(tmp_path):
+    data = numpy.arange(3 * 4 * 5, dtype='int16').reshape((3, 4, 5))
+    file_path = str(tmp_path / 'cached.nii.gz')
+    IOUtils.write_volume(file_path, Volume(data, numpy.eye(4), None))
+
+    IOUtils.enable_read_cache(max_bytes=data.nbytes + 1024)
+    try:
+        volume = IOUtils.read_volume(file_path)
+        cached_volume = IOUtils.read_volume(file_path)
+        assert cached_volume is not volume
+        assert cached_volume.data is volume.data
+        assert not volume.data.flags.writeable
+        with pytest.raises(ValueError):
+            volume.data[0, 0, 0] = 1
+
+        # the other attributes are copied for each read
+        cached_volume.header.set_data_dtype('float32')
+        assert IOUtils.read_volume(file_path).data is volume.data
+        assert IOUtils.read_volume(file_path).header.get_data_dtype() == numpy.int16
+
+        # a rewritten file is read again
+        IOUtils.write_volume(file_path, Volume(data + 1, numpy.eye(4), None))
+        assert numpy.array_equal(IOUtils.read_volume(file_path).data, data + 1)
+
+        # objects over the memory budget are not cached, but their arrays are read-only too
+        big_file_path = str(tmp_path / 'not-cached.nii.gz')
+        IOUtils.write_volume(big_file_path, Volume(numpy.zeros((30, 4, 5), dtype='int16'), numpy.eye(4), None))
+        big_volume = IOUtils.read_volume(big_file_path)
+        assert not big_volume.data.flags.writeable
+        assert IOUtils.read_volume(big_file_path).data is not big_volume.data
+
+        # lazy volumes are not cached
+        lazy_volume = IOUtils.read_volume(file_path, lazy=True)
+        assert lazy_volume.is_lazy()
+        assert lazy_volume.data.flags.writeable
+        assert IOUtils.read_volume(file_path, lazy=True).data is not lazy_volume.data
+    finally:
+        IOUtils.disable_read_cache()
+
+    assert IOUtils.read_volume(file_path).data.flags.writeable
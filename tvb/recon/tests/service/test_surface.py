@@ -1,13 +1,20 @@
 # -*- coding: utf-8 -*-
 
 import os
+import gdist
+import h5py
 import numpy
-from numpy.testing import assert_array_equal
+import scipy.io
+import scipy.sparse
+from numpy.testing import assert_array_equal, assert_allclose
+from trimesh.creation import icosphere
 from tvb.recon.algo.service.surface import SurfaceService
 from tvb.recon.io.annotation import AnnotationIO
 from tvb.recon.io.factory import IOUtils
 from tvb.recon.io.surface import FreesurferIO, H5SurfaceIO
+from tvb.recon.model.annotation import Annotation
 from tvb.recon.model.surface import Surface
+from tvb.recon.model.volume import Volume
 from tvb.recon.tests.base import (
     get_data_file, get_temporary_files_path, data_path)
 from ..base import BaseTest
@@ -54,6 +61,33 @@ class SurfaceTest(BaseTest):
                          len(lh_surface.triangles) + len(rh_surface.triangles))
         #assert len(out_region_mapping) == len(lh_region_mapping) + len(rh_region_mapping)
 
+    def test_merge_surfaces_and_annotations(self,):
+        sphere = icosphere(1)
+        surfaces = [Surface(numpy.array(sphere.vertices) + 3 * i_srf, numpy.array(sphere.faces, dtype='i'),
+                            area_mask=numpy.arange(sphere.vertices.shape[0]) % (i_srf + 2) > 0)
+                    for i_srf in range(3)]
+        annotations = [Annotation(numpy.arange(surface.n_vertices) % (i_srf + 1), numpy.ones((i_srf + 1, 5)) * i_srf,
+                                  ["region%d_%d" % (i_srf, i_region) for i_region in range(i_srf + 1)])
+                       for i_srf, surface in enumerate(surfaces)]
+
+        out_surface, out_annotation = self.service.merge_surfaces_and_annotations(surfaces, annotations)
+        assert_array_equal(out_surface.vertices, numpy.concatenate([surface.vertices for surface in surfaces]))
+        n_vertices = sphere.vertices.shape[0]
+        assert_array_equal(out_surface.triangles,
+                           numpy.concatenate([surface.triangles + i_srf * n_vertices
+                                              for i_srf, surface in enumerate(surfaces)]))
+        assert_array_equal(out_surface.area_mask, numpy.concatenate([surface.area_mask for surface in surfaces]))
+        assert_array_equal(out_annotation.region_mapping,
+                           numpy.concatenate([annotations[0].region_mapping, annotations[1].region_mapping + 1,
+                                              annotations[2].region_mapping + 3]))
+        assert out_annotation.region_names == ["region0_0", "region1_0", "region1_1",
+                                               "region2_0", "region2_1", "region2_2"]
+        assert_array_equal(out_annotation.regions_color_table[:, 0], [0, 1, 1, 2, 2, 2])
+
+        with self.assertRaises(ValueError):
+            self.service.merge_surfaces_and_annotations(
+                surfaces, annotations[:2] + [Annotation(numpy.zeros((3,), dtype='i'), numpy.ones((1, 5)), ["region"])])
+
     def test_extract_subsurf(self,):
         surface_parser = FreesurferIO()
         annot_parser = AnnotationIO()
@@ -111,3 +145,199 @@ class SurfaceTest(BaseTest):
         self.assertEqual(conn.shape, (16, 16))
         self.assertEqual(conn[0, 1], 100)
         self.assertEqual(conn[0, 10], 0)
+
+    def test_extract_subsurf_index_maps(self,):
+        # two squares of two triangles each, sharing the edge 1-4
+        vertices = numpy.array([[0, 0, 0], [1, 0, 0], [2, 0, 0], [0, 1, 0], [1, 1, 0], [2, 1, 0]], dtype='f')
+        triangles = numpy.array([[0, 1, 4], [0, 4, 3], [1, 2, 5], [1, 5, 4]], dtype='i')
+        surface = Surface(vertices, triangles)
+        verts_mask = numpy.array([False, True, True, False, True, True])
+        subsurf, new_to_old, old_to_new = self.service.extract_subsurf(surface, verts_mask, return_index_maps=True)
+        assert_array_equal(new_to_old, [1, 2, 4, 5])
+        assert_array_equal(old_to_new, [-1, 0, 1, -1, 2, 3])
+        assert_array_equal(subsurf.vertices, vertices[verts_mask])
+        assert_array_equal(subsurf.triangles, [[0, 1, 3], [0, 3, 2]])
+        self.assertEqual(subsurf.triangles.dtype, triangles.dtype)
+        assert_array_equal(new_to_old[subsurf.triangles], triangles[2:])
+
+    def test_vertex_connectivity_symmetric(self,):
+        vertices = numpy.array([[0, 0, 0], [1, 0, 0], [2, 0, 0], [0, 1, 0], [1, 1, 0], [2, 1, 0]], dtype='f')
+        triangles = numpy.array([[0, 1, 4], [0, 4, 3], [1, 2, 5], [1, 5, 4]], dtype='i')
+        surface = Surface(vertices, triangles)
+        edges = self.service.triangle_edges(triangles, len(vertices))
+        assert_array_equal(edges, [[0, 1], [0, 3], [0, 4], [1, 2], [1, 4], [1, 5], [2, 5], [3, 4], [4, 5]])
+        conn = self.service.vertex_connectivity(surface, symmetric=True)
+        self.assertEqual(conn.nnz, 2 * len(edges))
+        assert_array_equal(conn.toarray(), conn.toarray().T)
+        dist = self.service.vertex_connectivity(surface, metric='euclidean', symmetric=True)
+        # edges shared by two triangles are weighted once
+        self.assertAlmostEqual(dist[1, 4], 1)
+        self.assertAlmostEqual(dist[4, 1], 1)
+        self.assertAlmostEqual(dist[0, 4], numpy.sqrt(2))
+        assert_array_equal(self.service.vertex_connectivity(surface, mode="2D", metric='euclidean'),
+                           self.service.vertex_connectivity(surface, metric='euclidean').todense())
+
+    def test_compute_region_statistics(self,):
+        vertices = numpy.array([[0, 0, 0], [1, 0, 0], [2, 0, 0], [0, 1, 0], [1, 1, 0], [2, 1, 0]], dtype='f')
+        triangles = numpy.array([[0, 1, 4], [0, 4, 3], [1, 2, 5], [1, 5, 4]], dtype='i')
+        surface = Surface(vertices, triangles)
+        region_mapping = [10, 10, 20, 10, 10, 20]
+        regions = [20, 30, 10]
+        areas, centers, orientations = self.service.compute_region_statistics(regions, surface, region_mapping)
+        # border triangles count for both regions
+        assert_array_equal(areas, [1, 0, 2])
+        assert_array_equal(centers, [[2, 0.5, 0], [0, 0, 0], [0.5, 0.5, 0]])
+        assert_array_equal(orientations, [[0, 0, 1], [0, 0, 0], [0, 0, 1]])
+        assert_array_equal(areas, self.service.compute_areas_for_regions(regions, surface, region_mapping))
+        assert_array_equal(centers, self.service.compute_centers_for_regions(regions, surface, region_mapping))
+        assert_array_equal(orientations,
+                           self.service.compute_orientations_for_regions(regions, surface, region_mapping))
+
+    def test_compute_surface_components(self,):
+        # two squares of two triangles each, sharing the edge 1-4, and a separate triangle
+        vertices = numpy.array([[0, 0, 0], [1, 0, 0], [2, 0, 0], [0, 1, 0], [1, 1, 0], [2, 1, 0],
+                                [5, 0, 0], [6, 0, 0], [5, 1, 0]], dtype='f')
+        triangles = numpy.array([[0, 1, 4], [0, 4, 3], [1, 2, 5], [1, 5, 4], [6, 7, 8]], dtype='i')
+        surface = Surface(vertices, triangles)
+        components, comp_n_verts, comp_areas = self.service.compute_surface_components(surface)
+        assert_array_equal(components, [0, 0, 0, 0, 0, 0, 1, 1, 1])
+        assert_array_equal(comp_n_verts, [6, 3])
+        assert_array_equal(comp_areas, [2, 0.5])
+
+        # without the vertices 1 and 4, the two squares are disconnected
+        verts_mask = numpy.array([True, False, True, True, False, True, True, True, True])
+        n_components, components, comp_areas = \
+            self.service.connected_surface_components(surface=surface, verts_mask=verts_mask)
+        self.assertEqual(n_components, 5)
+        assert_array_equal(components, [0, -1, 1, 2, -1, 3, 4, 4, 4])
+        assert_array_equal(comp_areas, [0, 0, 0, 0, 0.5])
+
+        surface.area_mask = numpy.array([True, True, True, True, True, True, True, True, False])
+        components, comp_n_verts, comp_areas = \
+            self.service.compute_surface_components(surface, connectivity=surface.get_adjacency())
+        assert_array_equal(comp_n_verts, [6, 3])
+        assert_array_equal(comp_areas, [2, 0])
+
+    def test_compute_gdist_sparse(self,):
+        sphere = icosphere(2)
+        surfaces = [Surface(numpy.array(sphere.vertices) * 50, numpy.array(sphere.faces)),
+                    Surface(numpy.array(sphere.vertices)[:, [1, 0, 2]] * 40, numpy.array(sphere.faces)[:, [1, 0, 2]])]
+        out_paths = [self.temp_file_path("gdist.npz"), self.temp_file_path("gdist.h5")]
+        self.service.compute_gdist_sparse(surfaces, out_paths, max_distance=21.3, n_jobs=2, batch_size=50)
+        # the temporary files of the streamed .npz file are removed
+        self.assertEqual(sorted(os.listdir(self.temp_dir.name)), ["gdist.h5", "gdist.npz"])
+
+        gdist_npz = scipy.sparse.load_npz(out_paths[0])
+        with h5py.File(out_paths[1], 'r') as h5_file:
+            gdist_h5 = scipy.sparse.csr_matrix((h5_file["data"][:], h5_file["indices"][:], h5_file["indptr"][:]),
+                                               shape=tuple(h5_file.attrs["shape"]))
+        for surface, gdist_mat in zip(surfaces, [gdist_npz, gdist_h5]):
+            expected = gdist.local_gdist_matrix(surface.vertices, surface.triangles.astype('<i4'),
+                                                max_distance=21.3).tocsr()
+            self.assertEqual(gdist_mat.shape, expected.shape)
+            assert_array_equal(gdist_mat.indptr, expected.indptr)
+            assert_array_equal(gdist_mat.indices, expected.indices)
+            assert_allclose(gdist_mat.data, expected.data)
+
+    def test_compute_gdist_mat(self,):
+        sphere = icosphere(1)
+        os.environ['SUBJECTS_DIR'] = self.temp_dir.name
+        os.environ['SUBJECT'] = "subject"
+        os.makedirs(self.temp_file_path("subject", "surf"))
+        surfaces = {}
+        for h in 'lr':
+            surfaces[h] = Surface(numpy.array(sphere.vertices, dtype='f') * 30, numpy.array(sphere.faces, dtype='i'))
+            IOUtils.write_surface(self.temp_file_path("subject", "surf", "%sh.pial" % h), surfaces[h])
+
+        # a dict of the output file of each hemisphere is returned, instead of the matrix
+        mat_paths = self.service.compute_gdist_mat('pial', max_distance=21.3)
+        self.assertEqual(mat_paths, {h: self.temp_file_path("subject", "surf", "%sh.pial.gdist.mat" % h)
+                                     for h in 'rl'})
+        for h in 'lr':
+            expected = gdist.local_gdist_matrix(surfaces[h].vertices.astype('f8'), surfaces[h].triangles,
+                                                max_distance=21.3)
+            assert_allclose(scipy.io.loadmat(mat_paths[h])['gdist'].toarray(), expected.toarray())
+
+    def test_compute_bounded_geodesic_dist_affinity(self,):
+        sphere = icosphere(2)
+        surface = Surface(numpy.array(sphere.vertices) * 10, numpy.array(sphere.faces))
+        dist = self.service.vertex_connectivity(surface, metric='euclidean', symmetric=True)
+        geodist = self.service.compute_geodesic_dist_affinity(dist.todense())
+        for n_jobs in [1, 2]:
+            bounded_geodist = self.service.compute_geodesic_dist_affinity(dist, limit=5.0, n_jobs=n_jobs,
+                                                                          batch_size=40)
+            self.assertTrue(scipy.sparse.issparse(bounded_geodist))
+            within_limit = (geodist <= 5.0) & (geodist > 0)
+            assert_array_equal(bounded_geodist.toarray() > 0, within_limit)
+            assert_allclose(bounded_geodist.toarray()[within_limit], geodist[within_limit], rtol=1e-6)
+        normalized_geodist = self.service.compute_geodesic_dist_affinity(dist, norm=True, limit=5.0)
+        self.assertAlmostEqual(normalized_geodist.max(), 1.0)
+        assert_allclose(normalized_geodist.toarray() * bounded_geodist.max(), bounded_geodist.toarray(), rtol=1e-6)
+
+        # the zero distance between coincident nodes is kept, the distance of a node to itself is not
+        chain = scipy.sparse.csr_matrix(([0.0, 1.0, 0.0, 1.0], ([0, 1, 1, 2], [1, 2, 0, 1])), shape=(3, 3))
+        chain_geodist = self.service.compute_geodesic_dist_affinity(chain, limit=5.0)
+        assert_array_equal(chain_geodist.indptr, [0, 2, 4, 6])
+        assert_array_equal(chain_geodist.indices, [1, 2, 0, 2, 0, 1])
+        assert_allclose(chain_geodist.data, [0, 1, 0, 1, 1, 1])
+
+    def test_find_nearest_nodes(self,):
+        nodes_xyz = numpy.array(numpy.meshgrid(range(4), range(4), range(4), indexing='ij'), dtype='f').reshape(3, -1).T
+        random_state = numpy.random.RandomState(0)
+        # points at the center of a grid cell are as close to 8 nodes
+        points = numpy.r_[random_state.rand(200, 3) * 3, numpy.round(random_state.rand(200, 3) * 6) / 2,
+                          [[1.5, 1.5, 1.5], [10, 0, 0]]]
+        nearest, distances, too_far = self.service.find_nearest_nodes(points, nodes_xyz, max_distance=2.0,
+                                                                      batch_size=64)
+        all_distances = numpy.sqrt(numpy.sum((points[:, numpy.newaxis, :] - nodes_xyz) ** 2, axis=2))
+        assert_array_equal(nearest, numpy.argmin(all_distances, axis=1))
+        assert_allclose(distances, numpy.min(all_distances, axis=1))
+        assert_array_equal(numpy.where(too_far)[0], [401])
+
+    def test_sample_vol_on_surf(self,):
+        sphere = icosphere(3)
+        # the sphere sticks out of the volume along the first axis
+        vertices = numpy.array(sphere.vertices, dtype='f') * [11, 8, 8]
+        region_mapping = (vertices[:, 0] > 0).astype('i')
+        surf_path = self.temp_file_path('lh.sample-surf')
+        FreesurferIO().write(Surface(vertices, numpy.array(sphere.faces, dtype='i')), surf_path)
+        color_table = numpy.array([[10, 20, 30, 0, 0], [40, 50, 60, 0, 0]])
+        color_table[:, 4] = color_table[:, 0] + 256 * color_table[:, 1] + 65536 * color_table[:, 2]
+        annot_path = self.temp_file_path('lh.sample-surf.annot')
+        IOUtils.write_annotation(annot_path, Annotation(region_mapping, color_table, ['left', 'right']))
+        lut_path = self.temp_file_path('sample-lut.txt')
+        with open(lut_path, 'w') as lut_file:
+            lut_file.write("2 wm 0 0 0 0\n5 left 10 20 30 0\n6 right 40 50 60 0\n")
+        cras = numpy.array([0.3, -0.4, 0.2])
+        cras_path = self.temp_file_path('sample-cras.txt')
+        numpy.savetxt(cras_path, cras)
+        data = numpy.random.RandomState(0).choice([0, 2, 5, 6], size=(20, 20, 20), p=[0.94, 0.02, 0.02, 0.02])
+        affine = numpy.eye(4)
+        affine[:3, 3] = -10
+        vol_path = self.temp_file_path('sample-vol.nii.gz')
+        IOUtils.write_volume(vol_path, Volume(data.astype('int16'), affine, None))
+
+        # the labels of the voxels within vertex_neighbourhood of the nearest voxel of each vertex
+        ijk = numpy.round(vertices + cras + 10).astype('i')
+        vertices_labels = numpy.array([5, 6])[region_mapping]
+        for vertex_neighbourhood in [0, 1]:
+            for add_lbl in [[], [2]]:
+                expected_indices = []
+                for vertex_index, (i, j, k) in enumerate(ijk):
+                    # the vertices the nearest voxel of which is out of the volume are dropped
+                    if not (0 <= i < 20 and 0 <= j < 20 and 0 <= k < 20):
+                        continue
+                    vn = vertex_neighbourhood
+                    neighbours = data[max(0, i - vn):i + vn + 1, max(0, j - vn):j + vn + 1, max(0, k - vn):k + vn + 1]
+                    if numpy.in1d(neighbours, [vertices_labels[vertex_index]] + add_lbl).any():
+                        expected_indices.append(vertex_index)
+
+                out_surf_path = self.temp_file_path('lh.sampled')
+                surface, annotation = self.service.sample_vol_on_surf(
+                    surf_path, vol_path, annot_path, out_surf_path, cras_path,
+                    vertex_neighbourhood=vertex_neighbourhood, add_lbl=add_lbl, lut_path=lut_path)
+                assert_array_equal(numpy.load(out_surf_path + "-idx.npy"), expected_indices)
+                assert_allclose(surface.vertices, vertices[expected_indices])
+                assert_array_equal(annotation.region_mapping, region_mapping[expected_indices])
+                assert_array_equal(IOUtils.read_annotation(out_surf_path + ".annot").region_mapping,
+                                   region_mapping[expected_indices])
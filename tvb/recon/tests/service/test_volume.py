@@ -3,8 +3,10 @@
 import os
 
 import numpy
+import pytest
 
-from tvb.recon.algo.service.volume import VolumeService
+from tvb.recon.algo.service.volume import VolumeService, _dilate_block
+from tvb.recon.dax import AtlasSuffix
 from tvb.recon.io.factory import IOUtils
 from tvb.recon.model.volume import Volume
 from tvb.recon.tests.base import get_temporary_files_path, remove_temporary_test_files
@@ -25,6 +27,62 @@ def test_label_vol_from_tdi():
                               [[12, 13, 14], [15, 16, 0]]])
 
 
+def test_relabel():
+    service = VolumeService()
+    data = numpy.array([[[0, 3, 7], [-1, 3, 2]], [[7, 7, 0], [2, 5, 3]]])
+    relabeled = service.relabel(data, [3, 7, 2, 100], [0.5, 1.5, 2.5, 3.5], default=numpy.nan)
+    assert relabeled.dtype == numpy.float64
+    assert numpy.array_equal(relabeled, [[[numpy.nan, 0.5, 1.5], [numpy.nan, 0.5, 2.5]],
+                                         [[1.5, 1.5, numpy.nan], [2.5, numpy.nan, 0.5]]], equal_nan=True)
+    relabeled = service.relabel(data, [-1, 0, 7], [1, 2, 3], dtype='uint8')
+    assert relabeled.dtype == numpy.uint8
+    assert numpy.array_equal(relabeled, [[[2, 0, 3], [1, 0, 0]], [[3, 3, 2], [0, 0, 0]]])
+    # sparse labels are binary searched
+    sparse_data = data * 10 ** 9
+    relabeled = service.relabel(sparse_data, [7 * 10 ** 9, 2 * 10 ** 9], [1, 2], default=-1, out=sparse_data)
+    assert relabeled is sparse_data
+    assert numpy.array_equal(relabeled, [[[-1, -1, 1], [-1, -1, 2]], [[1, 1, -1], [2, -1, -1]]])
+
+
+def test_compact_label_dtype():
+    service = VolumeService()
+    assert service.compact_label_dtype([0, 1, 255]) == numpy.uint8
+    assert service.compact_label_dtype(numpy.array([-1, 0, 300])) == numpy.int16
+    assert service.compact_label_dtype(numpy.array([0., 70000.])) == numpy.uint32
+    assert service.compact_label_dtype([0.5, numpy.nan]) == numpy.float32
+    assert service.compact_label_dtype([0.1, 2]) == numpy.float64
+
+
+def test_change_labels_of_aparc_aseg():
+    service = VolumeService()
+    data = numpy.array([[[0, 1000, 1001], [2000, 2001, 5]], [[11100, 12100, 16], [1001, 0, 2001]]])
+    mapping_dict = {0: 0, 1001: 1, 2001: 2, 11100: 3, 12100: 4}
+    volume = service.change_labels_of_aparc_aseg("", Volume(data.copy(), [], None), mapping_dict, 5)
+    assert numpy.array_equal(volume.data, [[[0, -1, 1], [-1, 2, -1]], [[3, 4, -1], [1, 0, 2]]])
+    # the input dtype is kept
+    for dtype in ['int32', 'float32']:
+        volume = service.change_labels_of_aparc_aseg("", Volume(data.astype(dtype), [], None), mapping_dict, 5)
+        assert volume.data.dtype == dtype
+        assert numpy.array_equal(volume.data, [[[0, -1, 1], [-1, 2, -1]], [[3, 4, -1], [1, 0, 2]]])
+    # the input data is not changed in place, so it can be a read-only array
+    data.flags.writeable = False
+    volume = service.change_labels_of_aparc_aseg(AtlasSuffix.A2009S, Volume(data, [], None), mapping_dict, 5)
+    assert numpy.array_equal(volume.data, [[[0, 3, 1], [4, 2, -1]], [[3, 4, -1], [1, 0, 2]]])
+
+    # the unmatched values are gathered slab by slab, also when relabelling in place
+    unmatched = set()
+    relabelled = service.relabel(data.copy(), list(mapping_dict.keys()), list(mapping_dict.values()), default=-1,
+                                 unmatched=unmatched)
+    assert unmatched == {1000, 2000, 5, 16}
+    label_data = data.copy()
+    unmatched = set()
+    service._RELABEL_SLAB_VOXELS = 6
+    service.relabel(label_data, list(mapping_dict.keys()), list(mapping_dict.values()), default=-1,
+                    out=label_data, unmatched=unmatched)
+    assert unmatched == {1000, 2000, 5, 16}
+    assert numpy.array_equal(label_data, relabelled)
+
+
 def test_simple_label_config():
     service = VolumeService()
     data = numpy.array(
@@ -94,3 +152,175 @@ def test_remove_zero_connectivity():
 
     conn = numpy.array(numpy.genfromtxt(connectivity_path, dtype='int64'))
     assert numpy.array_equal(conn, [[20, 1, 3], [1, 20, 2], [3, 2, 20]])
+
+
+def test_remove_zero_connectivity_binary():
+    service = VolumeService()
+
+    data = numpy.array([[[0, 0, 1], [2, 3, 0]], [[4, 0, 0], [0, 0, 0]]])
+    volume = Volume(data, numpy.eye(4), None)
+    volume_path = get_temporary_files_path("tdi_lbl_bin.nii.gz")
+    IOUtils.write_volume(volume_path, volume)
+
+    in_connectivity = numpy.array(
+        [[10, 1, 0, 3], [0, 10, 0, 2], [0, 0, 0, 0], [0, 0, 0, 10]])
+    connectivity_path = get_temporary_files_path("conn_bin.npy")
+    numpy.save(connectivity_path, in_connectivity)
+
+    tract_lengths_path = get_temporary_files_path("tract_lengths_bin.npy")
+    numpy.save(tract_lengths_path, in_connectivity + 0.5)
+
+    service.remove_zero_connectivity_nodes(volume_path, connectivity_path, tract_lengths_path)
+
+    assert not os.path.exists(os.path.splitext(connectivity_path)[0] + ".csv")
+    assert numpy.array_equal(numpy.load(connectivity_path), [[20, 1, 3], [1, 20, 2], [3, 2, 20]])
+    # the float tract lengths are not truncated
+    assert numpy.array_equal(numpy.load(tract_lengths_path), [[10.5, 1.5, 3.5], [0.5, 10.5, 2.5], [0.5, 0.5, 10.5]])
+    vol = IOUtils.read_volume(volume_path)
+    assert numpy.array_equal(vol.data, [[[0, 0, 1], [2, 0, 0]], [[3, 0, 0], [0, 0, 0]]])
+
+
+def test_vol_to_ext_surf_vol():
+    service = VolumeService()
+
+    data = numpy.zeros((5, 5, 5), dtype='i')
+    data[1:4, 1:4, 1:4] = 10
+    data[0, 0, 0] = 11
+    volume = Volume(data, [[1, 0, 0, 0], [0, 1, 0, 0],
+                           [0, 0, 1, 0], [0, 0, 0, 1]], None)
+    volume_path = get_temporary_files_path("aseg.nii.gz")
+    IOUtils.write_volume(volume_path, volume)
+
+    out_volume_path = get_temporary_files_path("aseg-surf.nii.gz")
+    service.vol_to_ext_surf_vol(volume_path, labels="11 10", out_vol_path=out_volume_path)
+
+    expected = numpy.array(data)
+    expected[2, 2, 2] = 0
+    vol = IOUtils.read_volume(out_volume_path)
+    assert numpy.array_equal(vol.data, expected)
+
+    out_ijk = numpy.load(get_temporary_files_path("aseg-surf.nii-idx.npy"))
+    assert numpy.array_equal(out_ijk[0], [0, 0, 0])
+    assert out_ijk.shape == (27, 3)
+
+
+def test_mask_to_vol():
+    service = VolumeService()
+
+    affine = [[1, 0, 0, 0], [0, 1, 0, 0], [0, 0, 1, 0], [0, 0, 0, 1]]
+    data = numpy.zeros((6, 6, 6), dtype='i')
+    data[0, :, :] = 10
+    data[5, :, :] = 11
+    volume_path = get_temporary_files_path("aseg-surf.nii.gz")
+    IOUtils.write_volume(volume_path, Volume(data, affine, None))
+
+    mask_data = numpy.zeros((6, 6, 6), dtype='f')
+    mask_data[1, 2, 2] = 1.0
+    mask_path = get_temporary_files_path("gwi_mask.nii.gz")
+    IOUtils.write_volume(mask_path, Volume(mask_data, affine, None))
+
+    out_volume_path = get_temporary_files_path("aseg-mask.nii.gz")
+    service.mask_to_vol(volume_path, mask_path, out_volume_path, labels="10 11", vn=0, th=1)
+    vol = IOUtils.read_volume(out_volume_path)
+    assert numpy.all(vol.data == 0)
+
+    service.mask_to_vol(volume_path, mask_path, out_volume_path, labels="10 11", vn=1, th=1)
+    vol = IOUtils.read_volume(out_volume_path)
+    assert numpy.array_equal(numpy.argwhere(vol.data == 10), [[0, i, j] for i in range(1, 4) for j in range(1, 4)])
+    assert numpy.all(vol.data[5] == 0)
+    out_ijk = numpy.load(get_temporary_files_path("aseg-mask.nii-idx.npy"))
+    assert out_ijk.shape == (9, 3)
+
+
+def test_chained_operations_in_memory():
+    service = VolumeService()
+
+    data = numpy.zeros((6, 6, 6), dtype='i')
+    data[0:3, :, :] = 10
+    volume = Volume(data, numpy.eye(4), None)
+    mask_volume = Volume(numpy.ones((6, 6, 6), dtype='f'), numpy.eye(4), None)
+
+    out = numpy.empty_like(data)
+    surf_volume, surf_ijk = service.vol_to_ext_surf_vol(volume, labels="10", out=out, write=False)
+    assert surf_volume.data is out
+    # the input is left untouched, and only the voxels next to the background keep their label
+    assert numpy.all(data[0:3] == 10)
+    assert numpy.all(out[0:2] == 0)
+    assert numpy.all(out[2] == 10)
+
+    mask_volume.data[:, 0, :] = 0
+    masked_volume, masked_ijk = service.mask_to_vol(surf_volume, mask_volume, labels="10", vn=0, th=1,
+                                                    in_place=True, write=False)
+    assert masked_volume.data is out
+    assert numpy.all(out[:, 0, :] == 0)
+    assert surf_ijk.shape[0] == 36
+    assert masked_ijk.shape[0] == 30
+
+    with pytest.raises(ValueError):
+        service.mask_to_vol(surf_volume, mask_volume, labels="10", vn=0, th=1, out=out, in_place=True, write=False)
+
+    # read-only data, e.g. from the read cache, is copied instead of being changed in place
+    data.flags.writeable = False
+    surf_volume, _ = service.vol_to_ext_surf_vol(volume, labels="10", in_place=True, write=False)
+    assert surf_volume.data is not data
+    assert numpy.all(data[0:3] == 10)
+    assert numpy.all(surf_volume.data[0:2] == 0)
+
+
+def test_gen_label_volume_from_coords():
+    service = VolumeService()
+    ref_volume = Volume(numpy.zeros((7, 7, 7)), numpy.eye(4), None)
+    ref_volume_path = get_temporary_files_path("coords_ref.nii.gz")
+    IOUtils.write_volume(ref_volume_path, ref_volume)
+    out_volume_path = get_temporary_files_path("coords_out.nii.gz")
+
+    coords = numpy.array([[0, 0, 0], [3, 3, 3], [4, 3, 3]])
+    out_volume = service.gen_label_volume_from_coords(
+        numpy.array([1, 2, 3]), coords, ["a", "b", "c"], ref_volume_path, out_volume_path, dist=1)
+
+    assert out_volume.data.dtype == numpy.uint8
+    assert IOUtils.read_volume(out_volume_path).header.get_data_dtype() == numpy.uint8
+    assert numpy.array_equal(out_volume.data, IOUtils.read_volume(out_volume_path).data)
+    # the cube at the corner is clipped at the border
+    assert numpy.all(out_volume.data[0:2, 0:2, 0:2] == 1)
+    assert numpy.count_nonzero(out_volume.data == 1) == 8
+    # overlapping cubes are overwritten by the later contact
+    assert numpy.count_nonzero(out_volume.data == 2) == 9
+    assert numpy.all(out_volume.data[3:6, 2:5, 2:5] == 3)
+
+
+def test_transform_coords():
+    service = VolumeService()
+    # neurological orientation, so FSL flips the x axis of the scaled voxel coordinates
+    affine = numpy.array([[2, 0, 0, -10], [0, 2, 0, -12], [0, 0, 2, -14], [0, 0, 0, 1]])
+    volume_path = get_temporary_files_path("flirt_img.nii.gz")
+    IOUtils.write_volume(volume_path, Volume(numpy.zeros((10, 12, 14)), affine, None))
+    transform_mat_path = get_temporary_files_path("flirt.mat")
+    transform_mat = numpy.eye(4)
+    transform_mat[:3, 3] = [3, 4, 5]
+    numpy.savetxt(transform_mat_path, transform_mat)
+    out_path = get_temporary_files_path("flirt_coords.txt")
+
+    coords = numpy.array([[0, 0, 0], [1.5, -2, 7]])
+    transformed_coords, _ = service.transform_coords(coords, volume_path, volume_path, transform_mat_path, out_path)
+    assert numpy.allclose(transformed_coords, coords + [-3, 4, 5])
+    assert numpy.allclose(numpy.loadtxt(out_path, skiprows=1), transformed_coords)
+
+    transformed_coord, _ = service.transform_coords(coords[1], volume_path, volume_path, transform_mat_path)
+    assert numpy.allclose(transformed_coord, [-1.5, 2, 12])
+
+
+def test_blockwise_operations():
+    data = numpy.random.RandomState(0).randint(0, 4, (9, 6, 5))
+    serial_service = VolumeService()
+    parallel_service = VolumeService(n_jobs=3)
+
+    assert numpy.array_equal(parallel_service._face_neighbors_differ(data),
+                             serial_service._face_neighbors_differ(data))
+    assert numpy.array_equal(parallel_service.relabel(data, [1, 3], [10, 30], default=-1),
+                             serial_service.relabel(data, [1, 3], [10, 30], default=-1))
+
+    mask = data == 3
+    for vn in (1, 2):
+        assert numpy.array_equal(parallel_service.executor.run(_dilate_block, mask, halo=vn, args=(vn,)),
+                                 serial_service.executor.run(_dilate_block, mask, halo=vn, args=(vn,)))
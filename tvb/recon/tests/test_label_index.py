@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+
+import numpy
+from tvb.recon.model.label_index import LabelIndex
+
+
+def test_label_index():
+    data = numpy.random.RandomState(0).randint(-2, 6, (6, 7, 8))
+    data[data == 3] = 4
+    label_index = LabelIndex(data)
+
+    assert numpy.array_equal(label_index.labels, numpy.unique(data))
+    assert 3 not in label_index
+    assert label_index.count(3) == 0
+    assert label_index.voxels(3).shape == (0, 3)
+
+    for i, label in enumerate(label_index.labels):
+        vox_idx = numpy.argwhere(data == label)
+        assert label in label_index
+        assert label_index.count(label) == vox_idx.shape[0] == label_index.counts[i]
+        assert numpy.array_equal(label_index.voxels(label), vox_idx)
+        assert numpy.array_equal(label_index.bounding_boxes[i], [vox_idx.min(axis=0), vox_idx.max(axis=0)])
+        assert numpy.allclose(label_index.centroids[i], vox_idx.mean(axis=0))
+
+    affine = numpy.array([[-1, 0, 0, 10], [0, 2, 0, -5], [0, 0, 1, 3], [0, 0, 0, 1]])
+    assert numpy.allclose(label_index.centers(affine)[:, 0], 10 - label_index.centroids[:, 0])
@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+
+import numpy
+from trimesh.creation import icosphere
+from tvb.recon.model.surface import Surface
+
+
+def _grid_surface():
+    # two squares of two triangles each, sharing the edge 1-4
+    vertices = numpy.array([[0, 0, 0], [1, 0, 0], [2, 0, 0], [0, 1, 0], [1, 1, 0], [2, 1, 0]], dtype='f')
+    triangles = numpy.array([[0, 1, 4], [0, 4, 3], [1, 2, 5], [1, 5, 4]], dtype='i')
+    return Surface(vertices, triangles)
+
+
+def test_surface_topology():
+    surface = _grid_surface()
+
+    assert surface.get_vertex_triangles() == [[0, 1], [0, 2, 3], [2], [1], [0, 1, 3], [2, 3]]
+    assert surface.get_vertex_triangle_incidence() is surface.get_vertex_triangle_incidence()
+    assert numpy.array_equal(surface.get_edges(),
+                             [[0, 1], [0, 3], [0, 4], [1, 2], [1, 4], [1, 5], [2, 5], [3, 4], [4, 5]])
+    adjacency = surface.get_adjacency().toarray()
+    assert numpy.array_equal(adjacency, adjacency.T)
+    assert adjacency.sum() == 18
+    assert numpy.allclose(surface.get_triangle_areas(), 0.5)
+    assert numpy.allclose(surface.get_vertex_areas(), numpy.array([2, 3, 1, 1, 3, 2]) / 6.)
+
+    # replacing the vertices resets the areas, replacing the triangles also resets the topology
+    edges = surface.get_edges()
+    surface.vertices = 2 * surface.vertices
+    assert surface.get_edges() is edges
+    assert numpy.allclose(surface.get_triangle_areas(), 2)
+    adjacency = surface.get_adjacency()
+    surface.vertices = numpy.r_[surface.vertices, numpy.zeros((2, 3))]
+    assert surface.get_adjacency() is not adjacency
+    assert surface.get_adjacency().shape == (8, 8)
+    assert surface.get_vertex_triangle_incidence().shape == (8, 4)
+    assert numpy.array_equal(surface.get_edges(), edges)
+    surface.vertices = surface.vertices[:6]
+    assert surface.get_adjacency().shape == (6, 6)
+    surface.triangles = surface.triangles[:2]
+    assert surface.n_triangles == 2
+    assert surface.get_vertex_triangles() == [[0, 1], [0], [], [1], [0, 1], []]
+    assert numpy.array_equal(surface.get_edges(), [[0, 1], [0, 3], [0, 4], [1, 4], [3, 4]])
+
+    surface.add_vertices_and_triangles(numpy.zeros((3, 3)), numpy.array([[0, 1, 2]]), [True, False, True])
+    assert surface.n_vertices == 9
+    assert numpy.array_equal(surface.area_mask, [True] * 7 + [False, True])
+    assert surface.n_triangles == 3
+    assert surface.get_vertex_triangles()[6:] == [[2], [2], [2]]
+
+
+def test_surface_normals():
+    sphere = icosphere(3)
+    surface = Surface(numpy.array(sphere.vertices), numpy.array(sphere.faces))
+
+    angles = surface._get_triangle_angles()
+    assert angles.shape == (surface.n_triangles, 3)
+    assert numpy.allclose(angles.sum(axis=1), numpy.pi)
+    assert numpy.allclose(surface.get_triangle_areas()[:, 0],
+                          numpy.sqrt(numpy.sum(surface.compute_normals() ** 2, axis=1)) / 2)
+    assert numpy.allclose(surface._get_triangle_normals(), sphere.face_normals)
+
+    # the normals of a unit sphere point like the vertices
+    for weighting in ["area", "angle"]:
+        assert numpy.allclose(surface.vertex_normals(weighting), surface.vertices, atol=2e-2)
+        vertex_normals = surface.vertex_normals(weighting, dtype='float32')
+        assert vertex_normals.dtype == numpy.float32
+        assert numpy.allclose(vertex_normals, surface.vertex_normals(weighting), atol=1e-6)
+
+
+def test_surface_masked_area():
+    surface = _grid_surface()
+    vertex_areas = surface.get_vertex_areas()
+    assert vertex_areas is surface.get_vertex_areas()
+    assert numpy.isclose(vertex_areas.sum(), 2)
+
+    assert surface.get_masked_area() == 2
+    # only the triangles with all 3 vertices in the mask count
+    assert surface.get_masked_area([False, True, True, False, True, True]) == 1
+    assert surface.get_masked_area([True, True, False, False, True, False]) == 0.5
+    assert surface.get_masked_area(numpy.zeros((6,), dtype=bool)) == 0
+    surface.area_mask = numpy.array([True, True, True, True, True, False])
+    assert surface.get_masked_area() == 1